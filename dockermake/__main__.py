@@ -65,10 +65,17 @@ def run(args):
         cli.print_yaml_help()
         return
 
+    utils.configure_copy_cache(args)
+    if args.state_dir is not None:
+        staging.configure_state_dir(args.state_dir)
     if args.clear_copy_cache:
         staging.clear_copy_cache()
         return
 
+    if args.execute:
+        _summarize(*utils.execute_plan(args))
+        return
+
     if not os.path.exists(args.makefile):
         msg = 'No docker makefile found at path "%s"' % args.makefile
         if args.makefile == "DockerMake.yml":
@@ -87,10 +94,26 @@ def run(args):
         utils.list_image_defs(args, defs)
         return
 
+    if args.warm:
+        warnings = utils.warm_targets(args, defs, targets)
+        print("\ndocker-make finished warming images.")
+        if warnings:
+            print("Warnings:")
+            for item in warnings:
+                print(" *", item)
+        return
+
+    if args.plan:
+        utils.write_plan(args, defs, targets)
+        return
+
     # Actually build the images! (or just Dockerfiles)
-    built, warnings = utils.build_targets(args, defs, targets)
+    _summarize(*utils.build_targets(args, defs, targets))
+
 
-    # Summarize the build process
+def _summarize(built, warnings, failed, skipped):
+    """ Summarize the build process
+    """
     print("\ndocker-make finished.")
     print("Built: ")
     for item in built:
@@ -99,6 +122,19 @@ def run(args):
         print("Warnings:")
         for item in warnings:
             print(" *", item)
+    if failed:
+        termcolor.cprint("Failed:", "red")
+        for item in failed:
+            print(" *", item)
+    if skipped:
+        termcolor.cprint("Skipped (because something they need failed):", "yellow")
+        for item in skipped:
+            print(" *", item)
+    if failed:
+        raise errors.IncompleteBuildError(
+            "%d of %d builds failed or were skipped"
+            % (len(failed) + len(skipped), len(built) + len(failed) + len(skipped))
+        )
 
 
 if __name__ == "__main__":
@@ -14,17 +14,115 @@
 from __future__ import print_function
 
 import os
+import threading
 from builtins import object
+from collections import OrderedDict
+from concurrent.futures import Future
+import docker.errors
+import docker.utils
 from termcolor import cprint, colored
 
-from dockermake.step import FileCopyStep
+from dockermake.step import FileCopyStep, INPUT_HASH_LABEL
 from . import utils
+from . import cachesources
+from . import concurrency
+from . import daemons
+from . import filelocks
+from . import stepcache
+from . import timings
 
 
-_updated_staging_images = (
-    set()
-)  # stored per session so that we don't try to update them repeatedly
-_rebuilt = set()  # only rebuild a unique stack of images ONCE per session
+class BuildMemo(object):
+    """ Remembers the results of builds during this session, so that each one runs only once.
+
+    The first caller for a given key runs the build; callers that arrive while it's still
+    running wait for it to finish and receive the same result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def get_or_build(self, key, build):
+        """
+        Args:
+            key (hashable): uniquely identifies this build
+            build (callable): runs the build and returns its result
+
+        Returns:
+            object: the result of ``build()``, whether or not it ran in this call
+            bool: True if the result came from an earlier (or concurrent) call
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            cached = future is not None
+            if not cached:
+                future = self._futures[key] = Future()
+
+        if not cached:
+            try:
+                future.set_result(build())
+            except BaseException as exc:
+                future.set_exception(exc)
+
+        return future.result(), cached
+
+
+class StepTrieNode(object):
+    """ A step in the step trie. Each path from a root to a node is a unique stack of steps.
+
+    Args:
+        key (object): identifies this step relative to its parent
+        step (BuildStep): the step (None for the root nodes, which are base images)
+        parent (StepTrieNode): node for the previous step
+    """
+
+    def __init__(self, key, step=None, parent=None):
+        self.key = key
+        self.step = step
+        self.parent = parent
+        self.children = OrderedDict()
+        self.targets = []  # names of the targets whose final step is this one
+
+    def get_child(self, key, make_step):
+        if key not in self.children:
+            self.children[key] = StepTrieNode(key, make_step(), self)
+        return self.children[key]
+
+    def walk(self):
+        yield self
+        for child in self.children.values():
+            for node in child.walk():
+                yield node
+
+
+class StepTrie(object):
+    """ Merges the steps of all the targets in a session into a prefix tree, keyed by
+    base image, then by step definition (and buildargs) at each level.
+
+    Targets that share a prefix of steps share the BuildStep objects for that prefix, so
+    it's built once, and the targets' builds fan out from the point where they differ.
+    """
+
+    def __init__(self):
+        self.roots = OrderedDict()
+
+    def root(self, baseimage):
+        key = str(baseimage)
+        if key not in self.roots:
+            self.roots[key] = StepTrieNode(key)
+        return self.roots[key]
+
+    def steps(self):
+        """ Iterates over every unique step in the trie
+        """
+        for root in self.roots.values():
+            for node in root.walk():
+                if node.step is not None:
+                    yield node.step
+
+
+_built_steps = BuildMemo()  # each BuildStep is only built ONCE per session
 
 
 class BuildTarget(object):
@@ -72,7 +170,26 @@ class BuildTarget(object):
             outfile.write("\n".join(lines))
         print("Wrote %s" % path)
 
-    def build(self, client, nobuild=False, usecache=True, pull=False):
+    @property
+    def prebuilt_name(self):
+        """ str: where an image built from exactly this target's inputs is pushed to (and
+        pulled from, with ``pull_if_built``): the target's repository, tagged with the
+        input hash. None if the target isn't in a repository.
+        """
+        repository, _ = docker.utils.parse_repository_tag(self.targetname)
+        if "/" not in repository:
+            return None
+        return "%s:dmk-%s" % (repository, self.steps[-1].input_hash)
+
+    def build(
+        self,
+        client,
+        nobuild=False,
+        usecache=True,
+        pull=False,
+        build_sources=True,
+        built_stacks=None,
+    ):
         """
         Drives the build of the final image - get the list of steps and execute them.
 
@@ -81,10 +198,57 @@ class BuildTarget(object):
             nobuild (bool): just create dockerfiles, don't actually build the image
             usecache (bool): use docker cache, or rebuild everything from scratch?
             pull (bool): try to pull new versions of repository images?
+            build_sources (bool): build the images that files are copied from first
+               (False if the caller has already built them)
+            built_stacks (BuildMemo): final image IDs of the stacks of steps built so far
+               in this session; an identical stack is tagged instead of rebuilt
         """
-        if not nobuild:
-            self.update_source_images(client, usecache=usecache, pull=pull)
+        if nobuild:
+            return self._build_steps(client, nobuild, usecache, pull)
+
+        if built_stacks is None:
+            built_stacks = BuildMemo()
+        if build_sources:
+            self.update_source_images(
+                client, usecache=usecache, pull=pull, built_stacks=built_stacks
+            )
 
+        imageid, cached = built_stacks.get_or_build(
+            self._get_memo_key(usecache),
+            lambda: self._build_steps(client, nobuild, usecache, pull),
+        )
+        if cached:
+            daemons.ensure_image(client, imageid)
+            client.api.tag(imageid, *docker.utils.parse_repository_tag(self.targetname))
+            cprint(
+                'Image for "%s" was already built this session; tagged %s as "%s"'
+                % (self.imagename, imageid, self.targetname),
+                "green",
+            )
+            self.untag_intermediates(client)
+
+    def pull_prebuilt(self, client, built_stacks):
+        """ Pull this target's image from its repository instead of building it, if an
+        image with the same inputs was pushed there (see ``prebuilt_name``)
+
+        Args:
+            client (docker.Client): docker client object to pull with
+            built_stacks (BuildMemo): as in ``build`` (targets with the same steps will
+               be tagged with the pulled image)
+
+        Returns:
+            bool: True if the image was pulled
+        """
+        imageid = self._pull_prebuilt(client)
+        if imageid is None:
+            return False
+        built_stacks.get_or_build(self._get_memo_key(True), lambda: imageid)
+        self.finalizenames(client, imageid)
+        return True
+
+    def _build_steps(self, client, nobuild, usecache, pull):
+        """ Build each step in turn; returns the ID of the final image
+        """
         width = utils.get_console_width()
         cprint("\n" + "=" * width, color="white", attrs=["bold"])
 
@@ -105,24 +269,25 @@ class BuildTarget(object):
             )
 
             if not nobuild:
-                if step.bust_cache:
-                    stackkey = self._get_stack_key(istep)
-                    if stackkey in _rebuilt:
-                        step.bust_cache = False
-
-                step.build(client, usecache=usecache)
+                _, cached = _built_steps.get_or_build(
+                    step, lambda: _timed_build(step, client, usecache, self.targetname)
+                )
                 print(
-                    colored("* Created intermediate image", "green"),
+                    colored(
+                        "* Reused intermediate image"
+                        if cached
+                        else "* Created intermediate image",
+                        "green",
+                    ),
                     colored(step.buildname, "green", attrs=["bold"]),
                     end="\n\n",
                 )
 
-                if step.bust_cache:
-                    _rebuilt.add(stackkey)
-
         finalimage = step.buildname
 
         if not nobuild:
+            daemons.ensure_image(client, finalimage)  # in case it was built elsewhere
+            imageid = client.images.get(finalimage).id
             self.finalizenames(client, finalimage)
             line = 'FINISHED BUILDING "%s" (image definition "%s" from %s)' % (
                 self.targetname,
@@ -131,37 +296,140 @@ class BuildTarget(object):
             )
             cprint(_centered(line, width), color="green", attrs=["bold"])
             cprint("=" * width, color="white", attrs=["bold"], end="\n\n")
+            return imageid
+
+    def _pull_prebuilt(self, client):
+        """ Pull the image at ``prebuilt_name``, if it's in the registry
+
+        Returns:
+            str: ID of the pulled image (or None, if it has to be built)
+        """
+        name = self.prebuilt_name
+        if name is None:
+            return None
+        try:
+            client.api.inspect_distribution(name)
+        except docker.errors.APIError:  # not in the registry (or no access)
+            return None
+
+        cprint(
+            'Pulling %s for "%s" - it was built from the same inputs'
+            % (name, self.targetname),
+            "blue",
+        )
+        try:
+            image = client.images.pull(*docker.utils.parse_repository_tag(name))
+        except docker.errors.APIError as exc:
+            cprint("  Can't pull %s: %s - building instead" % (name, exc), "yellow")
+            return None
+        if image.labels.get(INPUT_HASH_LABEL) != self.steps[-1].input_hash:
+            cprint(
+                "  %s has a different input hash label - building instead" % name,
+                "yellow",
+            )
+            return None
+        return image.id
+
+    def _get_memo_key(self, usecache):
+        return (usecache,) + self._get_stack_key(len(self.steps) - 1)
 
     def _get_stack_key(self, istep):
-        names = [self.from_image]
+        """ Uniquely identifies the image produced by steps 0 through ``istep`` (and
+        whether any of them are rebuilt without the cache)
+        """
+        names = [str(self.from_image)]
         for i in range(istep + 1):
             step = self.steps[i]
             if isinstance(step, FileCopyStep):
-                continue
-            names.append(step.imagename)
+                names.append(
+                    (step.imagename, step.sourceimage, step.sourcepath, step.destpath)
+                )
+            else:
+                names.append(
+                    (
+                        step.imagename,
+                        tuple(sorted((step.buildargs or {}).items())),
+                        bool(step.bust_cache),
+                    )
+                )
         return tuple(names)
 
-    def update_source_images(self, client, usecache, pull):
+    def update_source_images(self, client, usecache, pull, built_stacks=None):
         for build in self.sourcebuilds:
-            if build.targetname in _updated_staging_images:
-                continue
             cprint("\nUpdating source image %s" % build.targetname, "blue")
-            build.build(client, usecache=usecache, pull=pull)
+            build.build(client, usecache=usecache, pull=pull, built_stacks=built_stacks)
             cprint('Finished with build image "%s"\n' % build.targetname, color="green")
 
     def finalizenames(self, client, finalimage):
         """ Tag the built image with its final name and untag intermediate containers
         """
-        client.api.tag(finalimage, *self.targetname.split(":"))
+        client.api.tag(finalimage, *docker.utils.parse_repository_tag(self.targetname))
         cprint('Tagged final image as "%s"' % self.targetname, "green")
+        stepcache.record_last_build(self.targetname, client.images.get(finalimage).id)
+        self.untag_intermediates(client)
+
+    def untag_intermediates(self, client):
+        """ Untag this target's intermediate images, except for steps that other targets
+        haven't finished using yet
+        """
         if not self.keepbuildtags:
             print("Untagging intermediate containers:", end="")
             for step in self.steps:
-                client.api.remove_image(step.buildname, force=True)
-                print(step.buildname, end=",")
+                if step.release():
+                    daemons.remove_image(client, step.buildname)
+                    print(step.buildname, end=",")
             print()
 
 
+def _timed_build(step, client, usecache, targetname):
+    daemons.ensure_image(client, step.baseimage)  # in case it was built elsewhere
+    key = stepcache.result_key(client, step)
+
+    # other docker-make processes building the same step wait for this one to finish
+    lock = filelocks.FileLock(
+        "step-%s" % (key or step.input_hash), "building %s" % step.imagename
+    )
+    with lock:
+        imageid = None
+        if key is not None and usecache and not step.bust_cache:
+            imageid = stepcache.lookup(client, key)
+        if imageid is not None and _prefers_cache_image(client, step, imageid):
+            imageid = None
+
+        if imageid is not None:
+            client.api.tag(imageid, *step.buildname.split(":"))
+            cprint(
+                "  Reusing image %s, built earlier from the same inputs" % imageid[:19],
+                "yellow",
+            )
+        else:
+            # without explicit cache images, docker can still use the last builds
+            cache_from = step.cache_from or stepcache.previous_builds(
+                client, [step.definition_key or step.input_hash, targetname]
+            )
+            with concurrency.build_slot(timings.step_key(step), step.resources):
+                step.build(client, usecache=usecache, cache_from=cache_from)
+            if key is not None:
+                stepcache.record(client, key, step.buildname)
+        stepcache.record_last_build(
+            step.definition_key or step.input_hash,
+            imageid or client.images.get(step.buildname).id,
+        )
+
+    if step.cache_name is not None:  # pushed once the target is finished
+        client.api.tag(step.buildname, *docker.utils.parse_repository_tag(step.cache_name))
+
+
+def _prefers_cache_image(client, step, imageid):
+    """ True if one of a step's explicit cache images is already here and could provide
+    its layers, and it isn't the recorded image - then docker builds from it instead
+    """
+    if not step.cache_from:
+        return False
+    useful = cachesources.resolve(client, step.cache_from, step.baseimage, pull=False)
+    return bool(useful) and imageid not in [client.images.get(i).id for i in useful]
+
+
 def _centered(s, w):
     leftover = w - len(s)
     if leftover < 0:
@@ -0,0 +1,96 @@
+# Copyright 2015-2017 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Chooses which images to pass to docker as ``cache_from`` for a build step.
+
+Docker can only match a step's instructions against a cache image that was built on
+exactly the same image as the step (i.e., whose history starts with the parent's whole
+history), so other candidates are never sent - or pulled.
+"""
+from __future__ import print_function
+
+import docker.errors
+import docker.utils
+from termcolor import cprint
+
+
+def resolve(client, candidates, parent, pull=True):
+    """ Filter the candidate cache images for a step, keeping only those that can
+    actually provide cache hits - the images whose history extends the step's parent's.
+
+    Candidates that aren't present locally are only pulled if none of the present ones
+    are useful - one at a time, in order of preference, until a useful one turns up.
+
+    Args:
+        client (docker.DockerClient): client for the daemon that builds the step
+        candidates (List[str]): cache images, in order of preference
+        parent (str): the image that the step is built on
+        pull (bool): pull missing candidates (otherwise, only consider the present ones)
+
+    Returns:
+        List[str]: the useful candidates, in order of preference
+    """
+    parent_history = _history(client, parent)
+    useful = {}
+    missing = []
+    for image in candidates:
+        history = _history(client, image)
+        if history is None:
+            missing.append(image)
+        else:
+            useful[image] = _extends(parent_history, history)
+
+    if pull and not any(useful.values()):
+        for image in missing:
+            if not _pull(client, image):
+                continue
+            useful[image] = _extends(parent_history, _history(client, image))
+            if useful[image]:
+                break
+
+    return [image for image in candidates if useful.get(image)]
+
+
+def _extends(parent_history, history):
+    """ True if an image's history starts with the parent's whole history, and has more
+    entries after it. If the parent's history is unknown, any image might help.
+    """
+    if parent_history is None:
+        return True
+    return len(history) > len(parent_history) and (
+        history[: len(parent_history)] == parent_history
+    )
+
+
+def _history(client, image):
+    """ An image's history, oldest first, as (instruction, size) pairs - which match
+    between pulled and locally built copies (unlike IDs and timestamps). None if the
+    image isn't present.
+    """
+    try:
+        history = client.api.history(image)
+    except docker.errors.NotFound:
+        return None
+    return [(entry.get("CreatedBy"), entry.get("Size")) for entry in reversed(history)]
+
+
+def _pull(client, image):
+    repository, tag = docker.utils.parse_repository_tag(image)
+    cprint("  Pulling cache image %s" % image, "blue")
+    try:
+        client.images.pull(repository, tag=tag or "latest")
+    except docker.errors.APIError as exc:
+        cprint("  Can't pull cache image %s: %s" % (image, exc), "yellow")
+        return False
+    return True
@@ -58,10 +58,82 @@ def make_arg_parser():
         nargs="*",
         help="Build a special image from these requirements. Requires --name",
     )
+    bo.add_argument(
+        "--plan",
+        metavar="PLAN.json",
+        help="Don't build anything; write the complete build plan for the targets "
+        "(steps, their inputs and input hashes, dependencies and tags) to this file",
+    )
+    bo.add_argument(
+        "--execute",
+        metavar="PLAN.json",
+        help="Build the targets in a plan written by --plan (or only the TARGETS "
+        "given, if any), without reading the makefile. Options that affect what gets "
+        "built (repository, tags, caching, build args) come from the plan.",
+    )
+    bo.add_argument(
+        "--shard",
+        type=_shard,
+        metavar="I/N",
+        help="Split the targets into N groups that take about as long to build (keeping "
+        "images that share steps or copy_from sources together), and only build group I "
+        "(1 to N). The groups only depend on the makefile, so each of N machines can "
+        "build its own shard with the same command.",
+    )
     bo.add_argument(
         "--name", type=str, help="Name for custom docker images (requires --requires)"
     )
 
+    pb = parser.add_argument_group("Parallel builds")
+    pb.add_argument(
+        "-j",
+        "--jobs",
+        type=_jobs,
+        default=1,
+        help="Build up to this many independent images at the same time (default: 1). "
+        "Pass `auto` to adjust the number of concurrent builds to the docker daemon's load",
+    )
+    pb.add_argument(
+        "--host",
+        action="append",
+        metavar="URL",
+        help="Build on the docker daemon at this URL (e.g., tcp://buildbox1:2375). "
+        "Repeat to spread the build over several daemons, each running up to --jobs "
+        "builds; images are copied between daemons as needed.",
+    )
+    pb.add_argument(
+        "-k",
+        "--keep-going",
+        action="store_true",
+        help="If a build fails, keep building everything that doesn't depend on it, "
+        "then report which images were built, failed and skipped",
+    )
+    pb.add_argument(
+        "--min-jobs",
+        type=int,
+        default=1,
+        help="Lower limit on concurrent builds for `--jobs auto` (default: 1)",
+    )
+    pb.add_argument(
+        "--max-jobs",
+        type=int,
+        help="Upper limit on concurrent builds for `--jobs auto` "
+        "(default: the number of CPUs available to the docker daemon)",
+    )
+    pb.add_argument(
+        "--cpu-budget",
+        type=float,
+        help="Number of CPUs that concurrent steps with declared `resources` can use "
+        "in total (default: the number of CPUs available to the docker daemon). "
+        "Only used with --jobs, and not with --host",
+    )
+    pb.add_argument(
+        "--memory-budget",
+        help="Memory that concurrent steps with declared `resources` can use in total, "
+        "e.g. `32g` (default: the docker daemon's total memory). "
+        "Only used with --jobs, and not with --host",
+    )
+
     df = parser.add_argument_group("Dockerfiles")
     df.add_argument(
         "-p",
@@ -96,12 +168,48 @@ def make_arg_parser():
         "for `bar`.",
         default="",
     )
+    ca.add_argument(
+        "--warm",
+        action="store_true",
+        help="Just pull the FROM images and --cache-repo images of the requested "
+        "targets, then exit. (Before a build, FROM images that aren't present locally "
+        "are always pulled this way - or all of them, with --pull. Cache images are "
+        "pulled during the build, only when they can provide cache hits.)",
+    )
+    ca.add_argument(
+        "--pull-jobs",
+        type=int,
+        default=4,
+        help="Maximum number of images to pull at the same time (default: 4)",
+    )
+    ca.add_argument(
+        "--cache-steps",
+        action="store_true",
+        help="Push every intermediate step to --cache-repo as well (tagged by its "
+        "position in the build, e.g. `foo:step2`), and use those images as cache "
+        "sources for the matching steps. Gives cache hits throughout each build, "
+        "including `copy_from` steps, on machines without a local cache.",
+    )
+    ca.add_argument(
+        "--pull-if-built",
+        action="store_true",
+        help="Before building a target, look in its repository for an image that was "
+        "built from exactly the same inputs, and pull it instead. (Pushed images are "
+        "also tagged with their input hash, so that they can be found this way.)",
+    )
     ca.add_argument(
         "--cache-tag",
         help="Tag to use for cached images; "
         "can be used with the --cache-repo option (see above).",
         default="",
     )
+    ca.add_argument(
+        "--canonical-order",
+        action="store_true",
+        help="Build every image's steps in a single order shared by the whole makefile "
+        "(wherever `requires` allows), so that images using the same components can "
+        "share more layers. Reports how many steps are shared.",
+    )
     ca.add_argument("--no-cache", action="store_true", help="Rebuild every layer")
     ca.add_argument(
         "--bust-cache",
@@ -115,6 +223,22 @@ def make_arg_parser():
         action="store_true",
         help="Remove docker-make's cache of files for `copy-from`.",
     )
+    ca.add_argument(
+        "--copy-cache-dir",
+        help="Where to cache files for `copy-from` (default: dmk_cache in the system's "
+        "temporary directory)",
+    )
+    ca.add_argument(
+        "--copy-cache-size",
+        help="Maximum size of the `copy-from` cache, e.g. `20g`. Beyond it, the least "
+        "recently used files are removed (default: no limit)",
+    )
+    ca.add_argument(
+        "--state-dir",
+        help="Where to keep records between runs - step durations, hashes of build "
+        "context files and step cache results (default: dmk_state in the system's "
+        "temporary directory, which may not survive a reboot)",
+    )
     ca.add_argument(
         "--keep-build-tags",
         action="store_true",
@@ -151,6 +275,13 @@ def make_arg_parser():
         "(only if image repository contains a URL) -- to push to dockerhub.com, "
         "use index.docker.io as the registry)",
     )
+    rt.add_argument(
+        "--push-jobs",
+        type=int,
+        default=2,
+        help="Maximum number of images to push at the same time (pushes run in the "
+        "background while the remaining images build; default: 2)",
+    )
     rt.add_argument(
         "--registry-user",
         "--user",
@@ -175,6 +306,29 @@ def make_arg_parser():
     return parser
 
 
+def _shard(value):
+    try:
+        index, count = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be I/N (e.g. 2/4), not %r" % value)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            "must be I/N with I from 1 to N, not %r" % value
+        )
+    return index, count
+
+
+def _jobs(value):
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "must be a number of jobs or `auto`, not %r" % value
+        )
+
+
 def print_yaml_help():
     print("A brief introduction to writing Dockerfile.yml files:\n")
 
@@ -0,0 +1,274 @@
+# Copyright 2015-2017 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Limits how many builds run on the docker daemon at the same time.
+"""
+from __future__ import print_function
+
+import threading
+import time
+from builtins import object
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import docker.utils
+from termcolor import cprint
+
+from . import daemons
+from . import timings
+from . import utils
+
+ADJUST_INTERVAL = 5.0  # minimum number of seconds between changes to the limit
+# How much longer than usual steps are taking (the "slowdown"), compared to previous builds:
+SLOWDOWN_HIGH = 1.5  # above this, the daemon is overloaded
+SLOWDOWN_LOW = 1.2  # below this, there's room for more builds
+SMOOTHING = 0.3  # weight of the newest measurement in the slowdown estimate
+
+_limiter = None
+_resource_pool = None
+
+
+def set_limiter(limiter):
+    """ Use this limiter for every build in this session (None for no limit)
+    """
+    global _limiter
+    _limiter = limiter
+
+
+def set_resource_pool(pool):
+    """ Admit builds according to this pool's resource budget (None for no budget)
+    """
+    global _resource_pool
+    _resource_pool = pool
+
+
+@contextmanager
+def build_slot(key, resources=None):
+    """ Wait for permission to start a build on the daemon, then time the build.
+
+    Args:
+        key (str): identifies the step for the timing store (see timings.step_key)
+        resources (dict): resources that the build will use (see BuildStep.resources)
+    """
+    if _resource_pool is not None and resources:
+        with _resource_pool.reserve(key, resources):
+            with _timed_slot(key):
+                yield
+    else:
+        with _timed_slot(key):
+            yield
+
+
+@contextmanager
+def _timed_slot(key):
+    if _limiter is None:
+        start = time.time()
+        yield
+        elapsed = time.time() - start
+    else:
+        with _limiter.slot() as started:
+            yield
+            elapsed = time.time() - started[0]
+        _limiter.observe(key, elapsed)
+
+    timings.get_store().record(key, elapsed)
+
+
+class ResourcePool(object):
+    """ Admission control for builds with declared resources: a build only starts if its
+    resources fit into what's left of the host's budget. Requests larger than the whole
+    budget are capped at the budget (so that they run by themselves).
+
+    Args:
+        cpus (float): CPU budget
+        memory (int): memory budget in bytes (``shm`` counts against it too)
+    """
+
+    def __init__(self, cpus, memory):
+        self.budget = {"cpus": float(cpus), "memory": int(memory)}
+        self.used = {"cpus": 0.0, "memory": 0}
+        self._cond = threading.Condition()
+
+    def _request(self, resources):
+        memory = resources.get("memory", 0) + resources.get("shm", 0)
+        return {
+            "cpus": min(resources.get("cpus", 0.0), self.budget["cpus"]),
+            "memory": min(memory, self.budget["memory"]),
+        }
+
+    def _fits(self, request):
+        return all(self.used[k] + request[k] <= self.budget[k] for k in request)
+
+    @contextmanager
+    def reserve(self, key, resources):
+        request = self._request(resources)
+        with self._cond:
+            if not self._fits(request):
+                cprint("  Waiting for resources to build %s" % key, "yellow")
+            while not self._fits(request):
+                self._cond.wait()
+            for k in request:
+                self.used[k] += request[k]
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                for k in request:
+                    self.used[k] -= request[k]
+                self._cond.notify_all()
+
+
+class AdaptiveLimiter(object):
+    """ Adjusts the number of concurrent builds to keep the daemon busy without
+    overloading it.
+
+    The limit goes up by one when builds are waiting and the daemon has spare capacity, and
+    is halved when it's overloaded. The daemon counts as overloaded if steps are taking
+    much longer than they did in earlier builds (according to the timing store), or if
+    ``client.info()`` reports many more running containers than it has CPUs.
+
+    Args:
+        client (docker.DockerClient): client for the daemon that builds are running on
+        min_jobs (int): never allow fewer than this many concurrent builds
+        max_jobs (int): never allow more than this many concurrent builds (default: the
+           number of CPUs reported by the daemon)
+    """
+
+    def __init__(self, client, min_jobs=1, max_jobs=None):
+        self.client = client
+        self.ncpu = self._get_info().get("NCPU", 1) or 1
+        self.min_jobs = max(1, min_jobs)
+        self.max_jobs = max(self.min_jobs, max_jobs or self.ncpu)
+        self.limit = max(self.min_jobs, min(self.max_jobs, self.ncpu // 2))
+
+        self.active = 0
+        self.waiting = 0
+        self.slowdown = 1.0
+        self._last_adjusted = time.time()
+        self._cond = threading.Condition()
+
+    def _get_info(self):
+        try:
+            return self.client.info()
+        except Exception:  # load information is advisory; never fail a build over it
+            return {}
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            self.waiting += 1
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.waiting -= 1
+            self.active += 1
+
+        started = [time.time()]
+        try:
+            yield started
+        finally:
+            with self._cond:
+                self.active -= 1
+                self._cond.notify_all()
+
+    def observe(self, key, elapsed):
+        """ Update the load estimate with a step's duration, and adjust the limit if needed
+        """
+        store = timings.get_store()
+        if key in store:
+            ratio = elapsed / max(store.estimate(key), 0.1)
+            with self._cond:
+                self.slowdown = SMOOTHING * ratio + (1.0 - SMOOTHING) * self.slowdown
+
+        if time.time() - self._last_adjusted >= ADJUST_INTERVAL:
+            self._adjust()
+
+    def _adjust(self):
+        running = self._get_info().get("ContainersRunning", 0)
+
+        with self._cond:
+            self._last_adjusted = time.time()
+            oldlimit = self.limit
+            if self.slowdown > SLOWDOWN_HIGH or running > 2 * self.ncpu:
+                self.limit = max(self.min_jobs, self.limit // 2)
+                self.slowdown = 1.0  # start measuring again at the new limit
+            elif (
+                self.waiting
+                and self.slowdown < SLOWDOWN_LOW
+                and running < self.ncpu
+                and self.limit < self.max_jobs
+            ):
+                self.limit += 1
+            self._cond.notify_all()
+
+        if self.limit != oldlimit:
+            cprint(
+                "Concurrent builds: %d -> %d (%d containers running on %d CPUs)"
+                % (oldlimit, self.limit, running, self.ncpu),
+                "yellow",
+            )
+
+
+class PushQueue(object):
+    """ Pushes images to their registries in the background, so that uploads overlap
+    with the builds that come after them.
+
+    Args:
+        client (docker.DockerClient): client to push with
+        jobs (int): maximum number of images to push at the same time
+    """
+
+    def __init__(self, client, jobs=2):
+        self.client = client
+        self._pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self._pushes = []  # list of (image name, future)
+
+    def submit(self, name, aliases=()):
+        """ Queue an image to be pushed
+
+        Args:
+            name (str): the image
+            aliases (List[str]): other names to tag the image with and push, after it
+               (None entries are skipped)
+        """
+        aliases = [alias for alias in aliases if alias is not None]
+        self._pushes.append((name, self._pool.submit(self._push, name, aliases)))
+
+    def _push(self, name, aliases):
+        client = self.client
+        if daemons.get_pool() is not None:  # push from the daemon that built it
+            client = daemons.client_for(name)
+        try:
+            success, warnings = utils.push(client, name)
+            for alias in aliases if success else []:
+                client.api.tag(name, *docker.utils.parse_repository_tag(alias))
+                warnings.extend(utils.push(client, alias)[1])
+            return success, warnings
+        except Exception as exc:  # report it with the other push results instead
+            return False, ["WARNING: push failed for %s. Message: %s" % (name, exc)]
+
+    def drain(self):
+        """ Wait for all queued pushes to finish
+
+        Returns:
+            List[Tuple[str, bool, List[str]]]: for each queued image, in order: its name,
+               whether the push succeeded, and any warnings
+        """
+        if self._pushes:
+            cprint("Waiting for %d push(es) to finish" % len(self._pushes), "blue")
+        self._pool.shutdown(wait=True)
+        return [
+            (name, future.result()[0], future.result()[1])
+            for name, future in self._pushes
+        ]
@@ -0,0 +1,163 @@
+# Copyright 2015-2017 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Builds on several docker daemons at once. Images that were built on one daemon are
+copied (with a streamed ``docker save | docker load``) to the others when they need them.
+"""
+from __future__ import print_function
+
+import threading
+from builtins import object
+
+import docker
+import docker.errors
+from termcolor import cprint
+
+from . import errors
+from . import utils
+
+_pool = None
+
+
+def set_pool(pool):
+    """ Build on this pool's daemons for the rest of the session (None for just one)
+    """
+    global _pool
+    _pool = pool
+
+
+def get_pool():
+    return _pool
+
+
+def ensure_image(client, image):
+    """ Make sure that an image is present on the daemon that ``client`` talks to. If it
+    isn't, but another daemon in the pool has it, it's copied from there. (If no daemon
+    has it, it's presumably in a registry, and the daemon will pull it when needed.)
+
+    Args:
+        client (docker.DockerClient): client for the daemon that needs the image
+        image (str): image name or ID
+    """
+    if _pool is not None:
+        _pool.ensure(client, image)
+
+
+def client_for(image):
+    """ A client for a daemon that has this image (if there's a pool of daemons), or else
+    the default client
+    """
+    if _pool is not None:
+        daemon = _pool.find(image)
+        if daemon is not None:
+            return daemon.client
+    return utils.get_client()
+
+
+def remove_image(client, image):
+    """ Remove an image from this daemon, and from any others it was copied to
+    """
+    clients = [client]
+    if _pool is not None:
+        clients.extend(d.client for d in _pool.daemons if d.client is not client)
+    for c in clients:
+        try:
+            c.api.remove_image(image, force=True)
+        except docker.errors.NotFound:  # e.g., a step that was never built
+            pass
+
+
+class Daemon(object):
+    """ A docker daemon to build on
+
+    Args:
+        client (docker.DockerClient): client for this daemon
+        name (str): name to report it by (for instance, its URL)
+    """
+
+    def __init__(self, client, name="docker"):
+        self.client = client
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def has_image(self, image):
+        try:
+            self.client.images.get(image)
+        except docker.errors.ImageNotFound:
+            return False
+        else:
+            return True
+
+
+class DaemonPool(object):
+    """ Several docker daemons that builds are spread across
+
+    Args:
+        urls (List[str]): daemon endpoints (for instance, ``tcp://buildbox1:2375``)
+    """
+
+    def __init__(self, urls):
+        self.daemons = []
+        for url in urls:
+            try:
+                client = docker.DockerClient(base_url=url, version="auto")
+            except docker.errors.DockerException as exc:
+                raise errors.CLIError("Can't connect to docker at %s: %s" % (url, exc))
+            self.daemons.append(Daemon(client, url))
+        self._locks = {}  # serializes copies of the same image to the same daemon
+        self._locks_guard = threading.Lock()
+
+    def _get_lock(self, daemon, image):
+        with self._locks_guard:
+            key = (daemon.name, image)
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def find(self, image, exclude=None):
+        """ Returns the first daemon that has this image (or None)
+        """
+        for daemon in self.daemons:
+            if daemon is not exclude and daemon.has_image(image):
+                return daemon
+        return None
+
+    def ensure(self, client, image):
+        """ See ``daemons.ensure_image``
+        """
+        target = next((d for d in self.daemons if d.client is client), None)
+        if target is None:
+            return
+
+        with self._get_lock(target, image):
+            if target.has_image(image):
+                return
+            source = self.find(image, exclude=target)
+            if source is None:
+                return
+            self.copy(image, source, target)
+
+    @staticmethod
+    def copy(image, source, target):
+        """ Stream an image (with all of its layers) from one daemon to another
+        """
+        cprint("  Copying image %s from %s to %s" % (image, source, target), "blue")
+        for item in target.client.api.load_image(source.client.api.get_image(image)):
+            if "error" in item or "errorDetail" in item:
+                raise errors.ImageTransferError(
+                    "Failed to copy image %s from %s to %s: %s"
+                    % (image, source, target, item.get("error", item))
+                )
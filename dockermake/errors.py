@@ -82,6 +82,18 @@ class ExperimentalDaemonRequiredError(UserException):
     CODE = 53
 
 
+class IncompleteBuildError(UserException):
+    CODE = 54
+
+
+class ImageTransferError(UserException):
+    CODE = 55
+
+
+class PlanMismatchError(UserException):
+    CODE = 56
+
+
 class BuildError(Exception):
     CODE = 200
 
@@ -0,0 +1,76 @@
+# Copyright 2015-2017 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Locks shared by all docker-make processes on this machine, so that concurrent runs (for
+instance, several CI jobs on one host) don't duplicate each other's work.
+"""
+from __future__ import print_function
+
+import os
+from builtins import object
+
+from termcolor import cprint
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; locks are then just no-ops
+    fcntl = None
+
+from . import staging
+
+
+def lock_dir():
+    """ Directory holding the lock files (in docker-make's state directory)
+    """
+    return os.path.join(staging.STATE_DIR, "locks")
+
+
+class FileLock(object):
+    """ An exclusive lock on a file in ``lock_dir()``, held by one process at a time.
+
+    Used as a context manager. If another process holds the lock, this waits for it (and
+    ``waited`` is then True).
+
+    Args:
+        name (str): name of the lock (a valid file name)
+        description (str): what the lock protects, for the message printed while waiting
+    """
+
+    def __init__(self, name, description=None):
+        self.path = os.path.join(lock_dir(), "%s.lock" % name)
+        self.description = description or name
+        self.waited = False
+        self._lockfile = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return self
+        os.makedirs(lock_dir(), exist_ok=True)
+        self._lockfile = open(self.path, "a")
+        try:
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):  # another process has it
+            self.waited = True
+            cprint(
+                "  Waiting for another docker-make process (%s)" % self.description,
+                "yellow",
+            )
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._lockfile is not None:
+            fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+            self._lockfile.close()
+            self._lockfile = None
@@ -0,0 +1,253 @@
+# Copyright 2015-2017 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Content hashes of build inputs, used to recognize builds that have already been done.
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import mmap
+import os
+import stat
+import threading
+import time
+from builtins import object
+from concurrent.futures import ThreadPoolExecutor
+
+import docker.utils.build
+
+from . import staging
+from . import utils
+
+CHUNKSIZE = 1 << 20
+MMAP_THRESHOLD = 16 << 20  # files at least this big are memory-mapped instead of read
+HASH_JOBS = min(8, os.cpu_count() or 1)  # files hashed at the same time
+INDEX_DIR = "context_index"
+
+# files modified this recently might change again within the same mtime, so their
+# digests aren't remembered
+RACY_SECONDS = 2.0
+
+# never part of a build's inputs: docker-make's generated Dockerfiles go here
+ALWAYS_IGNORED = ["_docker_make_tmp"]
+
+_indexes = {}  # maps each state and context directory to a FileIndex
+_indexes_lock = threading.Lock()
+
+
+def hash_build_context(path, dockerfile="Dockerfile", ignore=None):
+    """ Hash everything that docker would send to the daemon as a build context, and
+    the ignore rules that selected it.
+
+    The hash is a Merkle tree: each directory's digest covers the names, modes and
+    digests of its entries. File digests are remembered between runs (see
+    ``FileIndex``), so only new or modified files are read again.
+
+    Args:
+        path (str): the build context directory
+        dockerfile (str): path of the Dockerfile, relative to the context (it's always
+           included, even if it's ignored - unless it's one of docker-make's temporary
+           files)
+        ignore (List[str]): .dockerignore patterns (default: read the context's
+           .dockerignore file, if any)
+
+    Returns:
+        str: hex digest
+    """
+    root = os.path.abspath(path)
+    if ignore is None:
+        ignore = read_dockerignore(root)
+    patterns = list(ignore) + ALWAYS_IGNORED
+
+    relpaths = [
+        relpath
+        for relpath in docker.utils.build.exclude_paths(root, patterns, dockerfile)
+        if not _is_always_ignored(relpath)  # even if it's the Dockerfile
+    ]
+    entries = get_file_index(root).digest_files(relpaths)
+
+    digest = hashlib.sha256()
+    if not _is_always_ignored(dockerfile):
+        digest.update(("%s\0" % dockerfile).encode("utf-8"))
+    digest.update(("%s\0" % "\n".join(ignore)).encode("utf-8"))
+    digest.update(_tree_digest(entries).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _is_always_ignored(relpath):
+    """ True for docker-make's temporary files (such as a step's generated Dockerfile,
+    whose name depends on the step's name, and whose lines are hashed as the step's
+    inputs instead)
+    """
+    return os.path.normpath(relpath).split(os.sep)[0] in ALWAYS_IGNORED
+
+
+def get_file_index(root):
+    """ Returns the (session-wide) file index for a context directory
+    """
+    key = (staging.STATE_DIR, root)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = FileIndex(root)
+        return _indexes[key]
+
+
+def _tree_digest(entries):
+    """ Combine the entries of a context into the digest of its root directory
+
+    Args:
+        entries (Mapping[str, Tuple[int, str]]): maps relative paths to their mode and
+           digest (None for directories)
+    """
+    tree = {}  # maps each directory to {name: (mode, digest)}
+    for relpath, (mode, digest) in entries.items():
+        parent, name = os.path.split(relpath)
+        tree.setdefault(parent, {})[name] = (mode, digest)
+        while parent:  # directories of re-included files might not be entries
+            parent, name = os.path.split(parent)
+            tree.setdefault(parent, {}).setdefault(name, (stat.S_IFDIR, None))
+
+    dirdigests = {}
+    for directory in sorted(
+        tree, key=lambda d: d.count(os.sep) + bool(d), reverse=True
+    ):
+        digest = hashlib.sha256()
+        for name, (mode, filedigest) in sorted(tree[directory].items()):
+            if stat.S_ISDIR(mode):
+                filedigest = dirdigests.get(os.path.join(directory, name), "")
+            digest.update(("%s\0%o\0%s\n" % (name, mode, filedigest)).encode("utf-8"))
+        dirdigests[directory] = digest.hexdigest()
+    return dirdigests.get("", hashlib.sha256().hexdigest())
+
+
+class FileIndex(object):
+    """ Digests of the files in a directory, remembered between runs (in docker-make's
+    state directory) by inode, size and modification time.
+
+    Args:
+        root (str): the directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(
+            staging.STATE_DIR, INDEX_DIR, "%s.json" % hash_json(root)[:32]
+        )
+        self._lock = threading.Lock()
+        self.files = self._read()  # maps relpath to [inode, size, mtime_ns, digest]
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as jsonfile:
+                return json.load(jsonfile)["files"]
+        except (IOError, OSError, ValueError, KeyError):
+            return {}
+
+    def digest_files(self, relpaths):
+        """ Get the mode and digest of each path, hashing only files that have changed
+        since they were last hashed
+
+        Args:
+            relpaths (Iterable[str]): paths relative to the root
+
+        Returns:
+            Dict[str, Tuple[int, str]]: maps each path to its mode and digest (None for
+               directories)
+        """
+        with self._lock:  # one context at a time, so each file is hashed only once
+            entries = {}
+            tohash = []
+            for relpath in relpaths:
+                fullpath = os.path.join(self.root, relpath)
+                info = os.lstat(fullpath)
+                if stat.S_ISLNK(info.st_mode):
+                    digest = hash_bytes(os.readlink(fullpath).encode("utf-8"))
+                elif stat.S_ISREG(info.st_mode):
+                    key = [info.st_ino, info.st_size, info.st_mtime_ns]
+                    known = self.files.get(relpath)
+                    digest = known[3] if known and known[:3] == key else None
+                    if digest is None:
+                        tohash.append((relpath, key))
+                else:
+                    digest = None
+                entries[relpath] = (info.st_mode, digest)
+
+            if tohash:
+                self._hash_files(tohash, entries)
+            return entries
+
+    def _hash_files(self, tohash, entries):
+        fullpaths = [os.path.join(self.root, relpath) for relpath, _ in tohash]
+        if len(tohash) > 1:
+            with ThreadPoolExecutor(max_workers=HASH_JOBS) as pool:
+                digests = list(pool.map(hash_file, fullpaths))
+        else:
+            digests = [hash_file(fullpaths[0])]
+
+        racy = (time.time() - RACY_SECONDS) * 1e9
+        for (relpath, key), digest in zip(tohash, digests):
+            entries[relpath] = (entries[relpath][0], digest)
+            if key[2] < racy:
+                self.files[relpath] = key + [digest]
+        self._save()
+
+    def _save(self):
+        utils.write_atomically(
+            self.path, json.dumps({"root": self.root, "files": self.files})
+        )
+
+
+def hash_file(path):
+    """ Hex digest of a file's contents (memory-mapped, if it's big)
+    """
+    with open(path, "rb") as infile:
+        if os.fstat(infile.fileno()).st_size < MMAP_THRESHOLD:
+            return hash_file_object(infile)
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hash_bytes(mapped)
+
+
+def hash_file_object(fileobj):
+    """ Hex digest of everything left to read from a file object
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(CHUNKSIZE), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_json(obj):
+    """ Hash a JSON-serializable object (independently of dict ordering)
+
+    Returns:
+        str: hex digest
+    """
+    data = json.dumps(obj, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def read_dockerignore(path):
+    """ Patterns from the .dockerignore file in a directory (or [] if there isn't one)
+    """
+    ignorefile = os.path.join(path, ".dockerignore")
+    if not os.path.exists(ignorefile):
+        return []
+    with open(ignorefile, "r") as infile:
+        lines = [line.strip() for line in infile.read().splitlines()]
+    return [line for line in lines if line and not line.startswith("#")]
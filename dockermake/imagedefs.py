@@ -17,12 +17,16 @@ from __future__ import print_function
 from builtins import object
 
 import os
-from collections import OrderedDict
-import yaml
+import heapq
 import uuid
+from collections import OrderedDict, Counter
+import yaml
+import docker.errors
+import docker.utils
 
 import dockermake.step
 from . import builds
+from . import hashing
 from . import staging
 from . import errors
 from . import utils
@@ -30,10 +34,16 @@ from . import utils
 RECOGNIZED_KEYS = set(
     (
         "requires build_directory build copy_from FROM description _sourcefile"
-        " FROM_DOCKERFILE ignore ignorefile squash secret_files"
+        " FROM_DOCKERFILE ignore ignorefile squash secret_files resources"
     ).split()
 )
 SPECIAL_FIELDS = set("_ALL_ _SOURCES_".split())
+RESOURCE_KEYS = set("cpus memory shm".split())
+# number of characters of the content hash in the tags of FROM_DOCKERFILE images
+DOCKERFILE_TAG_LENGTH = 24
+# number of characters of the definition key in the tags of intermediate images
+STEPNAME_TAG_LENGTH = 24
+CUSTOM_TARGET_SOURCE = "command line arguments"
 
 
 class ImageDefs(object):
@@ -44,7 +54,7 @@ class ImageDefs(object):
         self._sources = set()
         self.makefile_path = makefile_path
         print("Working directory: %s" % os.path.abspath(os.curdir))
-        print("Copy cache directory: %s" % staging.TMPDIR)
+        print("Copy cache directory: %s" % staging.BUILD_CACHEDIR)
         try:
             ymldefs, alltargets = self.parse_yaml(self.makefile_path)
         except errors.UserException:
@@ -57,6 +67,11 @@ class ImageDefs(object):
         self.ymldefs = ymldefs
         self.all_targets = alltargets
         self._external_dockerfiles = {}
+        self._builds = {}  # one BuildTarget per image, target name and settings
+        self.steptrie = builds.StepTrie()
+        self._canonical_ranks = None
+        # makes the names of intermediate images unique to this run
+        self.build_id = uuid.uuid4().hex[:12]
 
     def parse_yaml(self, filename):
         # locate and verify the DockerMake.yml file
@@ -149,6 +164,9 @@ class ImageDefs(object):
                     " (step %s)" % imagename
                 )
 
+            if "resources" in defn:
+                _check_resources(ymlfilepath, imagename, defn["resources"])
+
             for key in defn:
                 if key not in RECOGNIZED_KEYS:
                     raise errors.UnrecognizedKeyError(
@@ -164,6 +182,7 @@ class ImageDefs(object):
         cache_repo="",
         cache_tag="",
         buildargs=None,
+        cache_steps=False,
         **kwargs,
     ):
         """
@@ -177,9 +196,32 @@ class ImageDefs(object):
             cache_repo (str): repository to get images for caches in builds
             cache_tag (str): tags to use from repository for caches in builds
             buildargs (dict): build-time dockerfile arugments
+            cache_steps (bool): also cache every intermediate step in ``cache_repo``,
+               tagged by its position in this image's build
             **kwargs (dict): extra keyword arguments for the BuildTarget object
+
+        Returns:
+            builds.BuildTarget: the build - the same object for the same image, target
+               name and settings, whether it was requested or is copied from
         """
-        build_uuid = str(uuid.uuid4())
+        key = (
+            image,
+            targetname,
+            cache_repo,
+            cache_tag,
+            tuple(sorted((buildargs or {}).items())),
+            cache_steps,
+            tuple(sorted(kwargs.items())),
+        )
+        if key in self._builds:
+            build = self._builds[key]
+            for step in build.steps:  # e.g. if it was first generated as a source image
+                if step.imagename in (rebuilds or []) and not isinstance(
+                    step, dockermake.step.FileCopyStep
+                ):
+                    step.bust_cache = True
+            return build
+
         from_image = self.get_external_base_image(image)
         if cache_repo or cache_tag:
             cache_from = utils.generate_name(image, cache_repo, cache_tag)
@@ -200,28 +242,49 @@ class ImageDefs(object):
             rebuilds = []
         else:
             rebuilds = set(rebuilds)
-
-        for base_name in self.sort_dependencies(image):
+        frozen_buildargs = tuple(sorted((buildargs or {}).items()))
+
+        def step_cache_name():
+            if not (cache_steps and cache_repo):
+                return None
+            steptag = "step%d" % istep
+            if cache_tag:
+                steptag = "%s-%s" % (cache_tag, steptag)
+            return utils.generate_name(image, cache_repo, steptag)
+
+        # Steps are shared with every other target that has the same prefix
+        node = self.steptrie.root(from_image)
+        stepkeys = [str(from_image)]  # identifies each step, the same way in every run
+        for base_name in self.build_order(image):
+            if build_steps and self._is_noop(base_name):
+                continue  # so that e.g. aliases have the same steps as what they alias
             istep += 1
-            buildname = self._generate_stepname(istep, image, build_uuid)
             secret_files = self.ymldefs[base_name].get("secret_files", None)
             squash = self.ymldefs[base_name].get("squash", bool(secret_files))
-            build_steps.append(
-                dockermake.step.BuildStep(
+            stepkeys.append(self._get_stepkey(base_name, frozen_buildargs))
+            definition_key = hashing.hash_json(stepkeys)
+            node = self._add_step(
+                node,
+                (base_name, frozen_buildargs),
+                lambda: dockermake.step.BuildStep(
                     base_name,
                     base_image,
                     self.ymldefs[base_name],
-                    buildname,
-                    bust_cache=base_name in rebuilds,
+                    self._generate_stepname(istep, image, definition_key),
                     build_first=build_first,
-                    cache_from=cache_from,
                     buildargs=buildargs,
                     squash=squash,
                     secret_files=secret_files,
-                )
+                ),
+                definition_key,
+                bust_cache=base_name in rebuilds,
+                cache_from=cache_from,
+                cache_name=step_cache_name(),
             )
+            node.step.parent = build_steps[-1] if build_steps else None
+            build_steps.append(node.step)
 
-            base_image = buildname
+            base_image = node.step.buildname
             build_first = None
 
             for sourceimage, files in (
@@ -230,31 +293,41 @@ class ImageDefs(object):
                 sourceimages.add(sourceimage)
                 for sourcepath, destpath in files.items():
                     istep += 1
-                    buildname = self._generate_stepname(istep, image, build_uuid)
-                    build_steps.append(
-                        dockermake.step.FileCopyStep(
+                    stepkeys.append([sourceimage, sourcepath, destpath])
+                    definition_key = hashing.hash_json(stepkeys)
+                    node = self._add_step(
+                        node,
+                        (base_name, sourceimage, sourcepath, destpath),
+                        lambda: dockermake.step.FileCopyStep(
                             sourceimage,
                             sourcepath,
                             destpath,
                             base_name,
                             base_image,
                             self.ymldefs[base_name],
-                            buildname,
-                            bust_cache=base_name in rebuilds,
+                            self._generate_stepname(istep, image, definition_key),
                             build_first=build_first,
-                            cache_from=cache_from,
-                        )
+                        ),
+                        definition_key,
+                        cache_from=cache_from,
+                        cache_name=step_cache_name(),
                     )
-                    base_image = buildname
+                    node.step.parent = build_steps[-1]
+                    build_steps.append(node.step)
+                    base_image = node.step.buildname
+        node.targets.append(targetname)
 
         sourcebuilds = [
-            self.generate_build(
-                img, img, cache_repo=cache_repo, cache_tag=cache_tag, **kwargs
-            )
-            for img in sourceimages
+            self._get_source_build(img, cache_repo, cache_tag, cache_steps, **kwargs)
+            for img in sorted(sourceimages)
         ]
+        for step in build_steps:
+            if isinstance(step, dockermake.step.FileCopyStep):
+                for sourcebuild in sourcebuilds:
+                    if sourcebuild.imagename == step.sourceimage:
+                        step.source_build = sourcebuild
 
-        return builds.BuildTarget(
+        self._builds[key] = builds.BuildTarget(
             imagename=image,
             targetname=targetname,
             steps=build_steps,
@@ -262,9 +335,84 @@ class ImageDefs(object):
             from_image=from_image,
             **kwargs,
         )
+        return self._builds[key]
+
+    def _get_source_build(self, image, cache_repo, cache_tag, cache_steps, **kwargs):
+        """ Returns the build for an image that other images copy files from. There's only
+        one BuildTarget per source image, no matter how many targets copy from it (or if
+        it's also requested).
+        """
+        return self.generate_build(
+            image,
+            image,
+            cache_repo=cache_repo,
+            cache_tag=cache_tag,
+            cache_steps=cache_steps,
+            **kwargs,
+        )
+
+    def _is_noop(self, image):
+        """ True if a definition doesn't change the image it's built on (for instance,
+        if it only has a ``requires`` list)
+        """
+        mydef = self.ymldefs[image]
+        return not (
+            mydef.get("build", "").strip()
+            or mydef.get("copy_from")
+            or mydef.get("squash")
+            or mydef.get("secret_files")
+        )
+
+    @staticmethod
+    def _add_step(
+        parent,
+        key,
+        make_step,
+        definition_key,
+        bust_cache=False,
+        cache_from=None,
+        cache_name=None,
+    ):
+        """ Find or create the node for a step in the step trie, and register another
+        target that uses it.
+
+        Args:
+            parent (builds.StepTrieNode): node for the previous step
+            key (tuple): identifies this step relative to its parent
+            make_step (callable): creates the BuildStep if this is a new node
+            definition_key (str): hash of this step's definition and those before it
+            bust_cache (bool): this target wants this step rebuilt without the cache
+            cache_from (str): this target's cache image, if any
+            cache_name (str): this target's cache image for this particular step, if any
+        """
+        node = parent.get_child(key, make_step)
+        step = node.step
+        step.definition_key = definition_key
+        step.add_user()
+        step.bust_cache = step.bust_cache or bust_cache
+        if cache_name and step.cache_name is None:
+            step.cache_name = cache_name  # pushed under the first target's name
+        for image in (cache_name, cache_from):
+            if image and image not in (step.cache_from or []):
+                step.cache_from = (step.cache_from or []) + [image]
+        return node
+
+    def _get_stepkey(self, base_name, frozen_buildargs):
+        defn = self.ymldefs[base_name]
+        return [
+            base_name,
+            defn["_sourcefile"],
+            defn.get("build", ""),
+            defn.get("build_directory", None),
+            frozen_buildargs,
+        ]
 
-    def _generate_stepname(self, istep, image, build_uuid):
-        return f"{istep}.{image}.dmk:{build_uuid}"
+    def _generate_stepname(self, istep, image, definition_key):
+        """ Names steps by their definitions, plus this run's ID - so that concurrent
+        docker-make processes never untag each other's intermediate images
+        """
+        tag = "%s-%s" % (definition_key[:STEPNAME_TAG_LENGTH], self.build_id)
+        return f"{istep}.{image}.dmk:{tag}"
 
     def sort_dependencies(self, image, dependencies=None):
         """
@@ -297,6 +445,214 @@ class ImageDefs(object):
         dependencies[image] = None
         return dependencies.keys()
 
+    def build_order(self, image):
+        """ The order in which to build this image's steps - canonical order, if enabled,
+        otherwise the order of each definition's ``requires`` list.
+
+        Args:
+           image (str): name of the image definition
+
+        Returns:
+            List[str]: names of the definitions to build, in order
+        """
+        steps = list(self.sort_dependencies(image))
+        if self._canonical_ranks is not None:
+            steps.sort(key=self._canonical_ranks.__getitem__)
+        return steps
+
+    def use_canonical_order(self):
+        """ Order every image's steps by a single global order, so that images that
+        share components build them in the same position, and can share those layers.
+
+        The global order is a topological sort of ALL the definitions in the makefile
+        (so it's the same no matter which targets are being built). When the ``requires``
+        constraints leave a choice, the definition required by the most images goes first,
+        and ties are broken by name.
+        """
+        names = [name for name in self.ymldefs if name not in SPECIAL_FIELDS]
+        requires = {name: self._get_requires(name) for name in names}
+
+        popularity = Counter()
+        for name in names:
+            # custom --requires/--name targets don't count, to keep the order stable
+            if self.ymldefs[name].get("_sourcefile") != CUSTOM_TARGET_SOURCE:
+                popularity.update(self._get_closure(name, requires))
+
+        dependents = {name: [] for name in names}
+        for name in names:
+            for dep in requires[name]:
+                dependents[dep].append(name)
+        waiting_on = {name: len(requires[name]) for name in names}
+
+        ready = [(-popularity[name], name) for name in names if not waiting_on[name]]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            _, name = heapq.heappop(ready)
+            order.append(name)
+            for child in dependents[name]:
+                waiting_on[child] -= 1
+                if not waiting_on[child]:
+                    heapq.heappush(ready, (-popularity[child], child))
+
+        # anything left over is part of a circular dependency, which is reported elsewhere
+        order.extend(sorted(set(names).difference(order)))
+        self._canonical_ranks = {name: rank for rank, name in enumerate(order)}
+
+    def _get_requires(self, image):
+        requires = self.ymldefs[image].get("requires", [])
+        if not isinstance(requires, list):
+            return []
+        return [dep for dep in requires if dep in self.ymldefs]
+
+    @staticmethod
+    def _get_closure(image, requires):
+        """ All of the definitions that an image requires (including itself), without
+        recursing infinitely if there are circular dependencies
+        """
+        closure = set()
+        stack = [image]
+        while stack:
+            name = stack.pop()
+            if name not in closure:
+                closure.add(name)
+                stack.extend(requires[name])
+        return closure
+
+    def count_unique_steps(self, images, canonical=None):
+        """ Count how many steps must be built for a list of images, given that images
+        share the steps in any common prefix of their build orders (definitions that don't
+        change the image aren't steps, as in ``generate_build``)
+
+        Args:
+            images (List[str]): names of the image definitions
+            canonical (bool): count using canonical order (default: the current order)
+
+        Returns:
+            int: number of unique steps to build
+            int: total number of steps if no steps were shared
+        """
+        saved_ranks = self._canonical_ranks
+        if canonical and saved_ranks is None:
+            self.use_canonical_order()
+        elif canonical is False:
+            self._canonical_ranks = None
+
+        prefixes = set()
+        total = 0
+        try:
+            for image in images:
+                try:
+                    base = self.get_external_base_image(image)
+                except errors.UserException:
+                    continue
+                if base is None:
+                    continue
+                order = self._step_keys(image)
+                total += len(order)
+                for i in range(len(order)):
+                    prefixes.add((str(base),) + tuple(order[: i + 1]))
+        finally:
+            self._canonical_ranks = saved_ranks
+
+        return len(prefixes), total
+
+    def shard(self, images, index, count):
+        """ Split images into ``count`` groups that take about as long to build, and
+        return group number ``index``. The split only depends on the definitions, so every
+        machine that runs this computes the same groups.
+
+        An image's cost is the number of steps it needs (including those of the images it
+        copies files from). Images that share steps are grouped together, most shared steps
+        first, as long as the group stays within its share of the total; then the groups
+        are dealt out to the shards, largest first, each to the least loaded shard.
+
+        Args:
+            images (List[str]): names of the image definitions
+            index (int): which group to return (from 1 to ``count``)
+            count (int): number of groups
+
+        Returns:
+            List[str]: the images in group ``index``, in their original order
+        """
+        names = sorted(set(images))
+        position = {name: i for i, name in enumerate(names)}
+        steps = [self._get_step_prefixes(name) for name in names]
+        allsteps = set().union(*steps) if steps else set()
+        maxsize = -(-len(allsteps) // count)  # i.e., ceil(len / count)
+
+        pairs = []
+        for i in range(len(names)):
+            for j in range(i + 1, len(names)):
+                shared = len(steps[i] & steps[j])
+                if shared:
+                    pairs.append((-shared, i, j))
+        pairs.sort()
+
+        groups = {i: ([names[i]], set(steps[i])) for i in range(len(names))}
+        group_of = list(range(len(names)))
+        for _, i, j in pairs:
+            gi, gj = group_of[i], group_of[j]
+            if gi == gj:
+                continue
+            merged = groups[gi][1] | groups[gj][1]
+            if len(merged) > maxsize:
+                continue
+            for name in groups[gj][0]:
+                group_of[position[name]] = gi
+            groups[gi] = (groups[gi][0] + groups.pop(gj)[0], merged)
+
+        shards = [([], 0) for _ in range(count)]
+        for members, groupsteps in sorted(
+            groups.values(), key=lambda g: (-len(g[1]), min(g[0]))
+        ):
+            ishard = min(range(count), key=lambda i: (shards[i][1], i))
+            shards[ishard] = (
+                shards[ishard][0] + members,
+                shards[ishard][1] + len(groupsteps),
+            )
+
+        selected = set(shards[index - 1][0])
+        return [image for image in images if image in selected]
+
+    def _get_step_prefixes(self, image, visited=None):
+        """ Identifies each step needed to build an image, including the steps of the images
+        that it copies files from (as in ``count_unique_steps``)
+        """
+        if visited is None:
+            visited = set()
+        if image in visited:
+            return set()
+        visited.add(image)
+
+        try:
+            base = self.get_external_base_image(image)
+        except errors.UserException:
+            return set()
+        if base is None:
+            return set()
+
+        order = self._step_keys(image)
+        prefixes = set((str(base),) + tuple(order[: i + 1]) for i in range(len(order)))
+        for name in self.build_order(image):
+            for source in self.ymldefs[name].get("copy_from", {}):
+                prefixes |= self._get_step_prefixes(source, visited)
+        return prefixes
+
+    def _step_keys(self, image):
+        """ Identifies the steps that ``generate_build`` creates for an image, in order -
+        one per definition that changes the image, and one per file copied into it
+        """
+        steps = []
+        for name in self.build_order(image):
+            if steps and self._is_noop(name):
+                continue
+            steps.append(name)
+            for source, files in self.ymldefs[name].get("copy_from", {}).items():
+                for sourcepath, destpath in files.items():
+                    steps.append((name, source, sourcepath, destpath))
+        return steps
+
     def get_external_base_image(self, image, stack=None):
         """ Makes sure that this image has exactly one unique external base image
         """
@@ -324,7 +680,12 @@ class ImageDefs(object):
         elif "FROM_DOCKERFILE" in mydef:
             path = mydef["FROM_DOCKERFILE"]
             if path not in self._external_dockerfiles:
-                self._external_dockerfiles[path] = ExternalDockerfile(path)
+                dockerfile = ExternalDockerfile(path)
+                for other in self._external_dockerfiles.values():
+                    if dockerfile == other:  # identical, from another _SOURCES_ file
+                        dockerfile = other
+                        break
+                self._external_dockerfiles[path] = dockerfile
             externalbase = self._external_dockerfiles[path]
         else:
             externalbase = None
@@ -358,10 +719,48 @@ class ImageDefs(object):
 
 
 class ExternalDockerfile(object):
+    """ A base image built from a Dockerfile (the ``FROM_DOCKERFILE`` field).
+
+    The image is tagged with a hash of the Dockerfile and its build context, so an
+    unchanged Dockerfile doesn't need to be rebuilt, and Dockerfiles with identical
+    contents and contexts are the same image.
+
+    Args:
+        path (str): path to the Dockerfile
+    """
+
     def __init__(self, path):
         self.path = path
         self.built = False
-        self.tag = uuid.uuid4()
+        self._digest = None
+
+    @property
+    def digest(self):
+        """ str: hash of the Dockerfile and its build context (None if it doesn't exist)
+        """
+        if self._digest is None and os.path.isfile(self.path):
+            self._digest = hashing.hash_build_context(
+                os.path.dirname(self.path), dockerfile=os.path.basename(self.path)
+            )
+        return self._digest
+
+    @property
+    def tag(self):
+        if self.digest is None:
+            raise errors.ExternalBuildError(
+                "No Dockerfile found at %s" % os.path.abspath(self.path)
+            )
+        return "dmk_dockerfile:%s" % self.digest[:DOCKERFILE_TAG_LENGTH]
+
+    def exists(self, client):
+        """ True if this image was already built (during this run or an earlier one)
+        """
+        try:
+            client.images.get(self.tag)
+        except docker.errors.ImageNotFound:
+            return False
+        else:
+            return True
 
     def __str__(self):
         return "Dockerfile at %s" % self.path
@@ -369,8 +768,36 @@ class ExternalDockerfile(object):
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             return False
+        elif self.path == other.path:
+            return True
         else:
-            return self.path == other.path
+            return self.digest is not None and self.digest == other.digest
+
+
+def _check_resources(ymlfilepath, imagename, resources):
+    if not isinstance(resources, dict):
+        raise errors.ParsingFailure(
+            'Syntax error in file "%s": \n' % ymlfilepath
+            + 'The "resources" field in image definition "%s" is not \n' % imagename
+            + "a key:value list."
+        )
+    for key, value in resources.items():
+        if key not in RESOURCE_KEYS:
+            raise errors.ParsingFailure(
+                'Unrecognized resource "%s" in image definition "%s" in file "%s" '
+                "(expected one of: %s)"
+                % (key, imagename, ymlfilepath, ", ".join(sorted(RESOURCE_KEYS)))
+            )
+        try:
+            if key == "cpus":
+                float(value)
+            else:
+                docker.utils.parse_bytes(value)
+        except (ValueError, TypeError, docker.errors.DockerException):
+            raise errors.ParsingFailure(
+                'Invalid value "%s" for resource "%s" in image definition "%s" in file "%s"'
+                % (value, key, imagename, ymlfilepath)
+            )
 
 
 def _get_abspath(pathroot, relpath):
@@ -0,0 +1,277 @@
+# Copyright 2015-2017 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Build plans: the fully resolved build for a set of targets (every step, its inputs and
+input hash, the dependencies between targets, and the tags they'll get), saved as JSON.
+A plan can be computed once and then executed on other machines, without the makefile.
+
+Paths in the plan are relative to the plan file's directory.
+"""
+from __future__ import print_function
+
+import json
+import os
+import uuid
+from collections import OrderedDict
+
+from . import builds
+from . import errors
+from .imagedefs import ExternalDockerfile
+from .step import BuildStep, FileCopyStep
+
+PLAN_VERSION = 1
+
+
+def write_plan(path, builders):
+    """ Write the plan for building these targets
+
+    Args:
+        path (str): file to write the plan to
+        builders (List[BuildTarget]): requested targets
+    """
+    plan = make_plan(builders, os.path.dirname(os.path.abspath(path)))
+    with open(path, "w") as planfile:
+        json.dump(plan, planfile, indent=2)
+
+
+def make_plan(builders, plandir):
+    """ Describes how to build these targets (see ``write_plan``)
+
+    Args:
+        builders (List[BuildTarget]): requested targets
+        plandir (str): directory that paths in the plan are relative to
+
+    Returns:
+        dict: the plan, as a JSON-serializable dict
+    """
+    steps = OrderedDict()
+    targets = OrderedDict()
+    dockerfiles = OrderedDict()
+    edges = []
+
+    def relpath(p):
+        return os.path.relpath(os.path.abspath(os.path.expanduser(p)), plandir)
+
+    def add_step(step):
+        if step.buildname in steps:
+            return
+        if step.build_first is not None:
+            dockerfiles[relpath(step.build_first.path)] = dict(
+                digest=step.build_first.digest, tag=step.build_first.tag
+            )
+
+        definition = OrderedDict(
+            [("build", step.img_def.get("build", "")), ("_sourcefile", step.sourcefile)]
+        )
+        if step.build_dir is not None:
+            definition["build_directory"] = relpath(step.build_dir)
+        if step.custom_exclude:
+            definition["ignore"] = "\n".join(step.custom_exclude)
+        if step.img_def.get("resources"):
+            definition["resources"] = step.img_def["resources"]
+
+        record = OrderedDict(
+            [
+                ("type", "copy" if isinstance(step, FileCopyStep) else "build"),
+                ("image", step.imagename),
+                ("input_hash", step.input_hash),
+                ("inputs", step.get_inputs()),
+                ("parent", step.parent.buildname if step.parent else None),
+                ("baseimage", step.baseimage),
+                (
+                    "build_first",
+                    relpath(step.build_first.path) if step.build_first else None,
+                ),
+                ("definition", definition),
+                ("buildargs", step.buildargs),
+                ("squash", bool(step.squash)),
+                ("secret_files", step.secret_files),
+                ("bust_cache", bool(step.bust_cache)),
+                ("cache_from", step.cache_from),
+                ("cache_name", step.cache_name),
+                ("definition_key", step.definition_key),
+            ]
+        )
+        if isinstance(step, FileCopyStep):
+            record["sourceimage"] = step.sourceimage
+            record["sourcepath"] = step.sourcepath
+            record["destpath"] = step.destpath
+            record["source_build"] = (
+                step.source_build.targetname if step.source_build else None
+            )
+        steps[step.buildname] = record
+
+    def add_target(builder, requested):
+        if builder.targetname in targets:
+            targets[builder.targetname]["requested"] |= requested
+            return
+        for sourcebuild in builder.sourcebuilds:
+            add_target(sourcebuild, False)
+            edges.append([sourcebuild.targetname, builder.targetname])
+        for step in builder.steps:
+            add_step(step)
+
+        if isinstance(builder.from_image, ExternalDockerfile):
+            from_image = dict(dockerfile=relpath(builder.from_image.path))
+        else:
+            from_image = builder.from_image
+        targets[builder.targetname] = OrderedDict(
+            [
+                ("image", builder.imagename),
+                ("requested", requested),
+                ("tag", builder.targetname),
+                ("from", from_image),
+                ("steps", [step.buildname for step in builder.steps]),
+                ("sourcebuilds", [b.targetname for b in builder.sourcebuilds]),
+                ("keepbuildtags", builder.keepbuildtags),
+            ]
+        )
+
+    for builder in builders:
+        add_target(builder, True)
+
+    return OrderedDict(
+        [
+            ("version", PLAN_VERSION),
+            ("targets", targets),
+            ("steps", steps),
+            ("dockerfiles", dockerfiles),
+            ("edges", edges),
+        ]
+    )
+
+
+def load_plan(path, targetnames=None):
+    """ Recreate the targets in a plan file
+
+    Args:
+        path (str): the plan file
+        targetnames (List[str]): only build these of the plan's requested targets (by
+           image definition name or tag; default: all of them)
+
+    Returns:
+        List[BuildTarget]: the requested targets
+    """
+    try:
+        with open(path, "r") as planfile:
+            plan = json.load(planfile)
+    except (IOError, OSError, ValueError) as exc:
+        raise errors.ParsingFailure("Failed to read plan %s:\n%s" % (path, exc))
+    if plan.get("version") != PLAN_VERSION:
+        raise errors.ParsingFailure(
+            "Plan %s has version %s; this version of docker-make executes version %s"
+            % (path, plan.get("version"), PLAN_VERSION)
+        )
+    plandir = os.path.dirname(os.path.abspath(path))
+
+    def abspath(p):
+        return os.path.normpath(os.path.join(plandir, p))
+
+    dockerfiles = {}
+    for relpath, record in plan["dockerfiles"].items():
+        dockerfile = ExternalDockerfile(abspath(relpath))
+        if dockerfile.digest != record["digest"]:  # it's tagged with the digest
+            raise errors.PlanMismatchError(
+                "%s (or its build context) is not the same as when plan %s was made"
+                % (dockerfile.path, path)
+            )
+        dockerfiles[relpath] = dockerfile
+
+    build_id = uuid.uuid4().hex[:12]  # intermediate names are unique to each run
+    steps = {}
+    for buildname, record in plan["steps"].items():
+        steps[buildname] = _load_step(buildname, record, dockerfiles, abspath, build_id)
+        steps[buildname].parent = steps.get(record["parent"])
+        if steps[buildname].parent is not None:
+            steps[buildname].baseimage = steps[buildname].parent.buildname
+
+    targets = {}
+    for targetname, record in plan["targets"].items():
+        from_image = record["from"]
+        if isinstance(from_image, dict):
+            from_image = dockerfiles[from_image["dockerfile"]]
+        targets[targetname] = builds.BuildTarget(
+            imagename=record["image"],
+            targetname=targetname,
+            steps=[steps[name] for name in record["steps"]],
+            sourcebuilds=[targets[name] for name in record["sourcebuilds"]],
+            from_image=from_image,
+            keepbuildtags=record["keepbuildtags"],
+        )
+
+    for buildname, record in plan["steps"].items():
+        if record.get("source_build"):
+            steps[buildname].source_build = targets[record["source_build"]]
+
+    requested = [t for t, record in plan["targets"].items() if record["requested"]]
+    if targetnames:
+        selected = []
+        for name in targetnames:
+            matches = [t for t in requested if name in (t, plan["targets"][t]["image"])]
+            if not matches:
+                raise errors.CLIError('Target "%s" is not in plan %s' % (name, path))
+            selected.extend(t for t in matches if t not in selected)
+        requested = selected
+
+    # only the targets that will be built (and their sources) use the steps
+    tocount = [targets[t] for t in requested]
+    counted = set()
+    while tocount:
+        target = tocount.pop()
+        if target.targetname not in counted:
+            counted.add(target.targetname)
+            tocount.extend(target.sourcebuilds)
+            for step in target.steps:
+                step.add_user()
+
+    return [targets[t] for t in requested]
+
+
+def _load_step(buildname, record, dockerfiles, abspath, build_id):
+    # same name as planned, but with this run's ID (see ImageDefs._generate_stepname)
+    buildname = "%s-%s" % (buildname.rsplit("-", 1)[0], build_id)
+    img_def = dict(record["definition"])
+    if "build_directory" in img_def:
+        img_def["build_directory"] = abspath(img_def["build_directory"])
+    build_first = dockerfiles.get(record["build_first"])
+
+    if record["type"] == "copy":
+        step = FileCopyStep(
+            record["sourceimage"],
+            record["sourcepath"],
+            record["destpath"],
+            record["image"],
+            record["baseimage"],
+            img_def,
+            buildname,
+            build_first=build_first,
+            cache_from=record["cache_from"],
+        )
+    else:
+        step = BuildStep(
+            record["image"],
+            record["baseimage"],
+            img_def,
+            buildname,
+            build_first=build_first,
+            bust_cache=record["bust_cache"],
+            cache_from=record["cache_from"],
+            buildargs=record["buildargs"],
+            squash=record["squash"],
+            secret_files=record["secret_files"],
+        )
+    step.cache_name = record.get("cache_name")
+    step.definition_key = record.get("definition_key")
+    step._input_hash = record["input_hash"]  # no need to hash everything again
+    return step
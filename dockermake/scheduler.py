@@ -0,0 +1,494 @@
+# Copyright 2015-2017 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function
+
+import heapq
+from builtins import object
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from termcolor import cprint
+
+from .step import BuildStep, FileCopyStep
+from . import builds
+from . import concurrency
+from . import daemons
+from . import staging
+from . import timings
+from . import utils
+
+
+class BuildNode(object):
+    """ A single unit of work in the build graph
+
+    Args:
+        key (tuple): unique identifier for this node
+        action (callable): called with a docker client to do this node's work
+        builder (BuildTarget): the requested target built by this node, if any
+    """
+
+    def __init__(self, key, action, builder=None):
+        self.key = key
+        self.action = action
+        self.builder = builder
+        self.daemon = None  # the daemons.Daemon that this node runs on
+        self.alias_of = None
+        self.deps = set()
+        self.dependents = set()
+        self.steps = []  # the BuildSteps this node builds
+        self.timing_key = None  # for nodes that aren't made of BuildSteps
+        self.rank = None  # estimated duration of the longest chain starting here
+
+    def __str__(self):
+        return ":".join(str(k) for k in self.key)
+
+
+class BuildScheduler(object):
+    """ Builds targets in dependency order, running independent targets concurrently.
+
+    The graph contains a node for each requested target, each of the images it copies
+    files from (``sourcebuilds``, recursively) and each ``FROM_DOCKERFILE`` image that has
+    to be built first. A node starts only after all of the nodes it depends on are done.
+    ``FROM_DOCKERFILE`` images don't depend on anything, and they're all started right
+    away, in addition to the ``jobs`` concurrent targets.
+
+    Targets with identical stacks of steps (same base image, steps and buildargs) are
+    only built once - the others wait for that build, then just tag its image.
+
+    When there are more nodes ready to build than free workers, the node at the head of
+    the longest remaining chain (according to the step durations recorded in previous
+    builds) goes first.
+
+    As soon as an image that other images copy files from is built, those files are
+    copied out of it in the background, so they're ready when the copy steps run.
+
+    With a pool of several daemons, each daemon runs up to ``jobs`` targets. A target
+    goes to the free daemon that's already building the longest prefix of its steps;
+    images that it needs from other daemons are copied over when it needs them.
+
+    Args:
+        builders (List[BuildTarget]): requested targets, in order of preference
+        client (docker.DockerClient): client to build with (None if nobuild)
+        jobs (int): maximum number of nodes to build at the same time
+        nobuild (bool): just create dockerfiles, don't actually build the images
+        usecache (bool): use docker cache, or rebuild everything from scratch?
+        pull (bool): try to pull new versions of repository images?
+        pull_if_built (bool): pull targets that were already built from the same inputs
+           from their repositories, instead of building them (or the images that they
+           copy files from)
+        keep_going (bool): when a node fails, only skip the nodes that depend on it, and
+           keep building everything else
+        daemon_pool (daemons.DaemonPool): build on these daemons, instead of just with
+           ``client``
+
+    Attributes:
+        failed (OrderedDict[BuildNode, Exception]): nodes that failed (with keep_going)
+        skipped (List[BuildNode]): nodes that weren't built because a dependency failed
+    """
+
+    def __init__(
+        self,
+        builders,
+        client,
+        jobs=1,
+        nobuild=False,
+        usecache=True,
+        pull=False,
+        pull_if_built=False,
+        keep_going=False,
+        daemon_pool=None,
+    ):
+        self.client = client
+        if daemon_pool is not None:
+            self.daemons = daemon_pool.daemons
+        else:
+            self.daemons = [daemons.Daemon(client)]
+        self._placed = {}  # maps each step to the daemon that it's built on
+        self.jobs = max(1, jobs)
+        self.nobuild = nobuild
+        self.usecache = usecache
+        self.pull = pull
+        self.pull_if_built = pull_if_built
+        self.keep_going = keep_going
+        self.failed = OrderedDict()
+        self.skipped = []
+        self.nodes = OrderedDict()
+        self._stacks = {}  # maps each target's final step to the node that builds it
+        self._built_stacks = builds.BuildMemo()  # final image of each stack built
+
+        for builder in builders:
+            self._add_target(builder, requested=True)
+
+        self._timings = timings.get_store()
+        for node in self.nodes.values():
+            self._compute_rank(node)
+
+        self._copies = OrderedDict()  # maps source image names to the paths copied
+        for node in self.nodes.values():
+            for step in node.steps:
+                if isinstance(step, FileCopyStep):
+                    paths = self._copies.setdefault(step.sourceimage, [])
+                    if step.sourcepath not in paths:
+                        paths.append(step.sourcepath)
+
+    def _add_target(self, builder, requested=False):
+        key = ("target", builder.targetname)
+        if key in self.nodes:
+            node = self.nodes[key]
+            if requested and node.builder is None:
+                node.builder = builder
+            return node
+
+        node = BuildNode(
+            key, self._target_action(builder), builder if requested else None
+        )
+        self.nodes[key] = node
+        if self.nobuild:
+            return node
+
+        finalstep = builder.steps[-1]
+        if finalstep in self._stacks:
+            # once the identical stack is built, this target's build just tags it
+            node.alias_of = self._stacks[finalstep]
+            self._add_edge(node.alias_of, node)
+            cprint(
+                '"%s" has the same steps as "%s"; it will be tagged, not rebuilt'
+                % (builder.targetname, node.alias_of.key[1]),
+                "blue",
+            )
+            return node
+        self._stacks[finalstep] = node
+        node.steps = builder.steps
+
+        for sourcebuild in builder.sourcebuilds:
+            self._add_edge(self._add_target(sourcebuild), node)
+
+        for step in builder.steps:
+            if step.build_first is not None:
+                self._add_edge(self._add_external_dockerfile(step.build_first), node)
+
+        return node
+
+    def _add_external_dockerfile(self, image):
+        key = ("dockerfile", image.path)
+        if key not in self.nodes:
+            timing_key = "FROM_DOCKERFILE %s" % image.path
+            node = BuildNode(
+                key,
+                lambda client: self._build_external_dockerfile(
+                    client, image, timing_key
+                ),
+            )
+            node.timing_key = timing_key
+            self.nodes[key] = node
+        return self.nodes[key]
+
+    @staticmethod
+    def _add_edge(upstream, downstream):
+        downstream.deps.add(upstream)
+        upstream.dependents.add(downstream)
+
+    def _target_action(self, builder):
+        def action(client):
+            builder.build(
+                client,
+                nobuild=self.nobuild,
+                usecache=self.usecache,
+                pull=self.pull,
+                build_sources=False,
+                built_stacks=self._built_stacks,
+            )
+
+        return action
+
+    @staticmethod
+    def _build_external_dockerfile(client, image, timing_key):
+        if image.built:
+            return
+        elif image.exists(client):  # built during an earlier run
+            BuildStep.build_external_dockerfile(client, image)
+        else:
+            with concurrency.build_slot(timing_key):
+                BuildStep.build_external_dockerfile(client, image)
+
+    def _cost(self, node):
+        """ Estimated time to build this node by itself, in seconds
+        """
+        cost = sum(
+            self._timings.estimate(timings.step_key(step)) for step in node.steps
+        )
+        if node.timing_key is not None:
+            cost += self._timings.estimate(node.timing_key)
+        return cost
+
+    def _compute_rank(self, node):
+        if node.rank is None:
+            node.rank = self._cost(node) + max(
+                [self._compute_rank(child) for child in node.dependents] or [0.0]
+            )
+        return node.rank
+
+    def estimate_makespan(self):
+        """ Estimate how long the build will take, by simulating it with each step's
+        estimated duration. A step that's shared between nodes is counted once; nodes
+        that start later must wait for it to finish.
+
+        Returns:
+            float: estimated total build time, in seconds
+        """
+        pending = OrderedDict(self.nodes)
+        finished = set()
+        running = []  # heap of (estimated end time, sequence number, node)
+        claimed = {}  # estimated end time for each step that's already started
+        now = 0.0
+        started = 0
+
+        while pending or running:
+            for node in self._ready(pending, finished):
+                if len(running) >= self.jobs * len(self.daemons):
+                    break
+                del pending[node.key]
+                end = now
+                for step in node.steps:
+                    if step in claimed:
+                        end = max(end, claimed[step])
+                    else:
+                        end += self._timings.estimate(timings.step_key(step))
+                        claimed[step] = end
+                if node.timing_key is not None:
+                    end += self._timings.estimate(node.timing_key)
+                heapq.heappush(running, (end, started, node))
+                started += 1
+
+            if not running:
+                break
+            now, _, node = heapq.heappop(running)
+            finished.add(node)
+
+        return now
+
+    def print_estimate(self):
+        steps = set(step for node in self.nodes.values() for step in node.steps)
+        numtimed = sum(1 for step in steps if timings.step_key(step) in self._timings)
+        cprint("Estimated build time:", "blue", end=" ")
+        print(
+            "%s with %d job(s); longest chain %s (%d of %d steps timed in earlier builds)"
+            % (
+                utils.human_readable_duration(self.estimate_makespan()),
+                self.jobs,
+                utils.human_readable_duration(
+                    max([node.rank for node in self.nodes.values()] or [0.0])
+                ),
+                numtimed,
+                len(steps),
+            )
+        )
+
+    def run(self, on_finished=None, on_built=None):
+        """ Build everything in the graph.
+
+        If any node fails, no new nodes are started; the nodes that are already running
+        are allowed to finish, then the first error is raised. With ``keep_going``, only
+        the nodes that depend on the failed node are skipped, and no error is raised -
+        see ``failed`` and ``skipped`` instead.
+
+        Args:
+            on_finished (callable): called in this thread with each requested BuildTarget
+               as soon as it has been built (and, for targets that were tagged from an
+               identical build, the name of that build's target)
+            on_built (callable): called in this thread with the BuildSteps of each
+               target that was built here - requested or not, such as the images that
+               requested targets copy files from
+        """
+        if len(self.daemons) > 1:
+            cprint(
+                "Building on %d daemons with up to %d concurrent jobs each: %s"
+                % (len(self.daemons), self.jobs, ", ".join(map(str, self.daemons))),
+                "blue",
+            )
+        elif self.jobs > 1:
+            cprint("Building with up to %d concurrent jobs" % self.jobs, "blue")
+        if not self.nobuild:
+            self.print_estimate()
+
+        try:
+            done = set()
+            if self.pull_if_built and self.usecache and not self.nobuild:
+                done = self._pull_prebuilt(on_finished)
+            self._run(on_finished, on_built, done)
+        finally:
+            if not self.nobuild:
+                self._timings.save()
+
+    def _pull_prebuilt(self, on_finished):
+        """ Before anything is built, pull the requested targets that were already built
+        from the same inputs (see ``BuildTarget.prebuilt_name``). Then the images that
+        they copy files from, and their other dependencies, are only built if some other
+        node still needs them.
+
+        Returns:
+            Set[BuildNode]: the nodes that don't have to run
+        """
+        candidates = [
+            node
+            for node in self.nodes.values()
+            if node.builder is not None
+            and node.alias_of is None
+            and node.builder.prebuilt_name is not None
+        ]
+        if not candidates:
+            return set()
+
+        client = self.daemons[0].client
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            pulls = [
+                (node, pool.submit(self._pull_node, node, client))
+                for node in candidates
+            ]
+        done = set(node for node, future in pulls if future.result())
+        for node in done:
+            node.daemon = self.daemons[0]
+            if on_finished is not None:
+                on_finished(node.builder)
+
+        # only what's upstream of the requested targets that weren't pulled is needed
+        needed = set()
+        tovisit = [
+            node
+            for node in self.nodes.values()
+            if node.builder is not None and node not in done
+        ]
+        while tovisit:
+            node = tovisit.pop()
+            if node not in needed:
+                needed.add(node)
+                tovisit.extend(node.deps)
+        for node in self.nodes.values():
+            if node not in needed and node not in done:
+                cprint("Not building %s - nothing else needs it" % node, "blue")
+                done.add(node)
+        return done
+
+    def _pull_node(self, node, client):
+        with utils.using_client(client):
+            return node.builder.pull_prebuilt(client, self._built_stacks)
+
+    def _run(self, on_finished, on_built=None, done=()):
+        pending = OrderedDict(
+            (key, node) for key, node in self.nodes.items() if node not in done
+        )
+        finished = set(done)
+        running = {}
+        error = None
+        numdockerfiles = sum(1 for key in self.nodes if key[0] == "dockerfile")
+        numworkers = self.jobs * len(self.daemons) + numdockerfiles
+        with ThreadPoolExecutor(max_workers=numworkers) as pool:
+            while running or (pending and error is None):
+                if error is None:
+                    for node in self._ready(pending, finished):
+                        if node.key[0] == "target":
+                            node.daemon = self._choose_daemon(node, running)
+                            if node.daemon is None:  # no free slots
+                                continue
+                        else:
+                            node.daemon = self.daemons[0]
+                        del pending[node.key]
+                        running[pool.submit(self._run_node, node)] = node
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    exc = future.exception()
+                    if exc is not None and self.keep_going:
+                        self._fail(node, exc, pending)
+                        continue
+                    elif exc is not None:
+                        if error is None:
+                            error = exc
+                        continue
+                    finished.add(node)
+                    self._prefetch(node)
+                    if node.steps and on_built is not None:
+                        on_built(node.steps)
+                    if node.builder is not None and on_finished is not None:
+                        if node.alias_of is not None:
+                            on_finished(node.builder, node.alias_of.key[1])
+                        else:
+                            on_finished(node.builder)
+
+        if error is not None:
+            raise error
+
+    def _choose_daemon(self, node, running):
+        """ Pick a daemon with a free slot for this node - preferably, the one that's
+        building the longest prefix of its steps. Returns None if they're all busy.
+        """
+        load = OrderedDict((daemon, 0) for daemon in self.daemons)
+        for other in running.values():
+            if other.key[0] == "target":
+                load[other.daemon] += 1
+
+        best, bestscore = None, None
+        for daemon, numrunning in load.items():
+            if numrunning >= self.jobs:
+                continue
+            prefix = 0
+            for step in node.steps:
+                if self._placed.get(step) is not daemon:
+                    break
+                prefix += 1
+            if node.alias_of is not None and node.alias_of.daemon is daemon:
+                prefix += 1  # tag it where the image already is
+            score = (prefix, -numrunning)
+            if bestscore is None or score > bestscore:
+                best, bestscore = daemon, score
+
+        if best is not None:
+            for step in node.steps:
+                self._placed.setdefault(step, best)
+        return best
+
+    def _run_node(self, node):
+        with utils.using_client(node.daemon.client):
+            node.action(node.daemon.client)
+
+    def _prefetch(self, node):
+        if self.nobuild or node.key[0] != "target":
+            return
+        for sourcepath in self._copies.get(node.key[1], []):
+            staging.prefetch(node.key[1], sourcepath)
+
+    def _fail(self, node, exc, pending):
+        """ Record a failed node, and skip everything downstream of it
+        """
+        self.failed[node] = exc
+        cprint("\nFAILED to build %s:" % node, "red", attrs=["bold"])
+        print(exc.args[0] if exc.args else repr(exc))
+
+        downstream = list(node.dependents)
+        while downstream:
+            child = downstream.pop()
+            if child.key in pending:
+                del pending[child.key]
+                self.skipped.append(child)
+                cprint("Skipping %s because %s failed" % (child, node), "yellow")
+                downstream.extend(child.dependents)
+
+    @staticmethod
+    def _ready(pending, finished):
+        """ Nodes that are ready to build, in order of priority (longest chain first)
+        """
+        ready = [node for node in pending.values() if node.deps <= finished]
+        ready.sort(key=lambda node: -node.rank)
+        return ready
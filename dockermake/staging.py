@@ -18,20 +18,334 @@ import docker.errors
 from builtins import object
 from termcolor import cprint
 
+import json
 import os
+import tarfile
 import tempfile
 import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
+from . import daemons
+from . import filelocks
+from . import hashing
 from . import utils
 from . import errors
 
 TMPDIR = tempfile.gettempdir()
 BUILD_CACHEDIR = os.path.join(TMPDIR, "dmk_cache")
 BUILD_TEMPDIR = os.path.join(TMPDIR, "dmk_download")
+STATE_DIR = os.path.join(TMPDIR, "dmk_state")  # records kept between runs
+PREFETCH_JOBS = 2  # maximum number of files to copy out of images in the background
+CACHE_INDEX = "cache_index.json"  # size and last use of each cached file
+BLOBS_DIR = "blobs"  # cached files, stored by the digest of their content
+REFS_DIR = "refs"  # the digest of the files at each source image ID and path
+
+# files used this recently are never evicted from the cache (a build may be reading them)
+EVICTION_GRACE_SECONDS = 600
+
+_max_cache_size = None  # in bytes; None for no limit
+
+_cachedir_locks = {}  # serializes downloads of the same file by concurrent builds
+_cachedir_locks_guard = threading.Lock()
+
+
+_fetches = {}  # maps (source image ID, path) to a Future for the path's cache directory
+_fetches_lock = threading.Lock()
+_prefetch_pool = None
+
+
+def configure_copy_cache(cachedir=None, maxsize=None):
+    """ Set where files copied out of images are cached, and how big the cache can get
+
+    Args:
+        cachedir (str): the cache directory (default: dmk_cache in the system's
+           temporary directory)
+        maxsize (int): size limit in bytes - beyond it, the least recently used files
+           are evicted (default: no limit)
+    """
+    global BUILD_CACHEDIR, BUILD_TEMPDIR, _max_cache_size
+    if cachedir is not None:
+        BUILD_CACHEDIR = os.path.abspath(os.path.expanduser(cachedir))
+        BUILD_TEMPDIR = os.path.join(BUILD_CACHEDIR, "_download")  # same filesystem
+    _max_cache_size = maxsize
+
+
+def configure_state_dir(statedir):
+    """ Set where the records that are kept between runs go - step durations, hashes of
+    build context files, step cache results and locks
+
+    Args:
+        statedir (str): the state directory (default: dmk_state in the system's
+           temporary directory)
+    """
+    global STATE_DIR
+    STATE_DIR = os.path.abspath(os.path.expanduser(statedir))
+
+
+def _get_cachedir_lock(cachedir):
+    with _cachedir_locks_guard:
+        if cachedir not in _cachedir_locks:
+            _cachedir_locks[cachedir] = threading.Lock()
+        return _cachedir_locks[cachedir]
+
+
+def prefetch(sourceimage, sourcepath):
+    """ Start copying a file or directory out of an image into the cache in the
+    background, so that it's ready by the time a build step needs it.
+
+    Args:
+        sourceimage (str): name of the image to copy from (it must already be built)
+        sourcepath (str): path in the source image
+    """
+    global _prefetch_pool
+    with _fetches_lock:
+        if _prefetch_pool is None:
+            _prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_JOBS)
+    fetch(sourceimage, sourcepath, pool=_prefetch_pool)
+
+
+def fetch(sourceimage, sourcepath, pool=None):
+    """ Copy a file or directory out of an image into the cache, unless it's already
+    there or being copied.
+
+    Args:
+        sourceimage (str): name of the image to copy from
+        sourcepath (str): path in the source image
+        pool (concurrent.futures.Executor): copy in this pool (default: copy it now, in
+           this thread)
+
+    Returns:
+        concurrent.futures.Future: resolves to the cache directory that contains the
+           copied files (as ``content.tar``)
+    """
+    client = daemons.client_for(sourceimage)
+    imageid = client.images.get(sourceimage).id
+    key = (imageid, sourcepath)
+
+    with _fetches_lock:
+        future = _fetches.get(key)
+        if future is not None and not _is_stale(future):
+            return future
+        if pool is not None:
+            future = pool.submit(_download, client, sourceimage, imageid, sourcepath)
+        else:
+            future = Future()
+        _fetches[key] = future
+
+    if pool is None:
+        try:
+            future.set_result(_download(client, sourceimage, imageid, sourcepath))
+        except Exception as exc:
+            future.set_exception(exc)
+    return future
+
+
+def _is_stale(future):
+    """ True if a fetch failed, or its cached files have been removed since
+    """
+    if not future.done():
+        return False
+    return future.exception() is not None or not os.path.exists(
+        os.path.join(future.result(), "content.tar")
+    )
+
+
+def _download(client, sourceimage, imageid, sourcepath):
+    refpath = os.path.join(
+        BUILD_CACHEDIR,
+        REFS_DIR,
+        imageid.replace("sha256:", ""),
+        sourcepath.replace("/", "_-"),
+    )
+
+    # another process could evict it before it's marked as used, so check again after
+    while True:
+        blobdir = _fill_cache(client, sourceimage, sourcepath, refpath)
+        _record_use(blobdir)
+        if os.path.exists(os.path.join(blobdir, "content.tar")):
+            return blobdir
+
+
+def _fill_cache(client, sourceimage, sourcepath, refpath):
+    """ Make sure that the files are cached, and return the directory they're in.
+
+    Files are stored by the digest of their content (see ``content_digest``), so
+    identical files copied from different images (e.g., a source image that was rebuilt
+    without changing them) are stored once. The first tarball stored for a digest is
+    kept, so the images they're copied into get the same build context, and docker's
+    cache still applies to those builds.
+
+    Args:
+        client (docker.DockerClient): client to copy the files with
+        sourceimage (str): name of the image to copy from
+        sourcepath (str): path in the source image
+        refpath (str): file recording the digest of the content at this image and path
+    """
+    os.makedirs(BUILD_TEMPDIR, exist_ok=True)
+    os.makedirs(os.path.dirname(refpath), exist_ok=True)
+    refrelpath = os.path.relpath(refpath, BUILD_CACHEDIR)
+
+    # lock out other threads, then other docker-make processes
+    filelock = filelocks.FileLock(
+        "copy-%s" % hashing.hash_json(refrelpath)[:32], "copying %s" % sourcepath
+    )
+    with _get_cachedir_lock(refpath), filelock:
+        # the content may have been evicted (or purged by the OS) since it was copied
+        blobdir = _read_ref(refpath)
+        if blobdir is not None and os.path.exists(os.path.join(blobdir, "content.tar")):
+            return blobdir
+
+        container = client.containers.create(sourceimage)
+        try:
+            tarfile_stream, tarfile_stats = container.get_archive(sourcepath)
+        except docker.errors.NotFound:
+            raise errors.MissingFileError(
+                'Cannot copy file "%s" from image "%s" - it does not exist!'
+                % (sourcepath, sourceimage)
+            )
+
+        # write files to disk (would be nice to stream them, haven't gotten it to work)
+        tempdir = tempfile.mkdtemp(dir=BUILD_TEMPDIR)
+        with open(os.path.join(tempdir, "content.tar"), "wb") as localfile:
+            for chunk in tarfile_stream:
+                localfile.write(chunk)
+        digest = content_digest(os.path.join(tempdir, "content.tar"))
+
+        blobdir = os.path.join(BUILD_CACHEDIR, BLOBS_DIR, digest)
+        blobrelpath = os.path.relpath(blobdir, BUILD_CACHEDIR)
+        os.makedirs(os.path.dirname(blobdir), exist_ok=True)
+        try:
+            os.rename(tempdir, blobdir)
+        except OSError:  # the same content is already cached
+            if not os.path.exists(os.path.join(blobdir, "content.tar")):
+                raise
+            shutil.rmtree(tempdir)
+            print(" * Same content as cached %s" % blobrelpath)
+        else:
+            print(" * Created cache at %s" % blobrelpath)
+
+        utils.write_atomically(refpath, digest)
+        return blobdir
+
+
+def content_digest(tarpath):
+    """ Digest of the files in a tarball - their names, modes, owners and contents, but
+    not their timestamps, which change whenever the files are rebuilt
+
+    Returns:
+        str: hex digest
+    """
+    members = []
+    with tarfile.open(tarpath, "r") as archive:
+        for member in archive:
+            if member.isfile():
+                data = hashing.hash_file_object(archive.extractfile(member))
+            else:
+                data = member.linkname
+            header = [member.name, member.type.decode("ascii"), "%o" % member.mode]
+            header += [member.uid, member.gid, member.uname, member.gname, data]
+            members.append("\0".join(map(str, header)) + "\n")
+    return hashing.hash_bytes("".join(sorted(members)).encode("utf-8"))
+
+
+def _read_ref(refpath):
+    """ Returns the blob directory that a ref points to (None if there's no ref)
+    """
+    try:
+        with open(refpath, "r") as reffile:
+            digest = reffile.read().strip()
+    except (IOError, OSError):
+        return None
+    return os.path.join(BUILD_CACHEDIR, BLOBS_DIR, digest)
+
+
+def _record_use(cachedir):
+    """ Mark a cached file as just used in the cache's index, then evict the least
+    recently used files if the cache is over its size limit
+    """
+    indexlock = filelocks.FileLock(
+        "copy-index-%s" % hashing.hash_json(BUILD_CACHEDIR)[:32],
+        "updating the copy cache index",
+    )
+    with indexlock:
+        index = _read_cache_index()
+        key = os.path.relpath(cachedir, BUILD_CACHEDIR)
+        if key not in index:
+            index[key] = dict(size=_cached_size(cachedir))
+        index[key]["used"] = time.time()
+        if _max_cache_size is not None:
+            _evict(index, _max_cache_size)
+        _write_cache_index(index)
+
+
+def _read_cache_index():
+    """ Read the cache's index (or build it from the cache's contents, if there isn't
+    one yet). Must be called with the index locked.
+
+    Returns:
+        dict: maps the path of each cached file, relative to BUILD_CACHEDIR, to a dict
+           with its ``size`` (in bytes) and when it was last ``used``
+    """
+    try:
+        with open(os.path.join(BUILD_CACHEDIR, CACHE_INDEX), "r") as indexfile:
+            return json.load(indexfile)["files"]
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    index = {}
+    blobsdir = os.path.join(BUILD_CACHEDIR, BLOBS_DIR)
+    for digest in os.listdir(blobsdir) if os.path.isdir(blobsdir) else []:
+        contentpath = os.path.join(blobsdir, digest, "content.tar")
+        if os.path.exists(contentpath):
+            index[os.path.join(BLOBS_DIR, digest)] = dict(
+                size=os.path.getsize(contentpath), used=os.path.getmtime(contentpath)
+            )
+    return index
+
+
+def _write_cache_index(index):
+    utils.write_atomically(
+        os.path.join(BUILD_CACHEDIR, CACHE_INDEX), json.dumps({"files": index})
+    )
+
+
+def _cached_size(cachedir):
+    try:
+        return os.path.getsize(os.path.join(cachedir, "content.tar"))
+    except OSError:
+        return 0
+
+
+def _evict(index, maxsize):
+    """ Remove the least recently used files from the cache until it fits in ``maxsize``
+    bytes (but never files used in the last EVICTION_GRACE_SECONDS)
+    """
+    total = sum(entry["size"] for entry in index.values())
+    cutoff = time.time() - EVICTION_GRACE_SECONDS
+    for key, entry in sorted(index.items(), key=lambda item: item[1]["used"]):
+        if total <= maxsize or entry["used"] > cutoff:
+            break
+        cprint(
+            "  Evicting %s from the copy cache (%s)"
+            % (key, utils.human_readable_size(entry["size"])),
+            "yellow",
+        )
+        # move it out of the way first, so no one sees a partially deleted directory
+        cachedir = os.path.join(BUILD_CACHEDIR, key)
+        if os.path.exists(cachedir):
+            trash = tempfile.mkdtemp(dir=BUILD_TEMPDIR)
+            os.rename(cachedir, os.path.join(trash, "evicted"))
+            shutil.rmtree(trash)
+        del index[key]
+        total -= entry["size"]
 
 
 def clear_copy_cache():
     for path in (BUILD_CACHEDIR, BUILD_TEMPDIR):
+        if path.startswith(BUILD_CACHEDIR + os.sep):
+            continue  # removed along with the cache directory
         if os.path.exists(path):
             assert os.path.isdir(path), "'%s' is not a directory!"
             cprint("Removing docker-make cache %s" % path, "yellow")
@@ -54,16 +368,15 @@ class StagedFile(object):
         self.sourceimage = sourceimage
         self.sourcepath = sourcepath
         self.destpath = destpath
-        self._sourceobj = None
-        self._cachedir = None
         self.cache_from = cache_from
 
-    def stage(self, startimage, newimage):
+    def stage(self, startimage, newimage, labels=None):
         """ Copies the file from source to target
 
         Args:
             startimage (str): name of the image to stage these files into
             newimage (str): name of the created image
+            labels (dict): labels for the created image
         """
         client = utils.get_client()
         cprint(
@@ -72,74 +385,37 @@ class StagedFile(object):
             "blue",
         )
 
-        # copy build artifacts from the container if necessary
-        cachedir = self._setcache(client)
-        cacherelpath = os.path.relpath(cachedir, TMPDIR)
-
-        # if cached file doesn't exist (presumably purged by OS), trigger it to be recreated
-        if os.path.exists(cachedir) and not os.path.exists(
-            os.path.join(cachedir, "content.tar")
-        ):
-            shutil.rmtree(cachedir)
-
-        if not os.path.exists(cachedir):
-            print(" * Creating cache at %s" % cacherelpath)
-            container = client.containers.create(self.sourceimage)
-            try:
-                tarfile_stream, tarfile_stats = container.get_archive(self.sourcepath)
-            except docker.errors.NotFound:
-                raise errors.MissingFileError(
-                    'Cannot copy file "%s" from image "%s" - it does not exist!'
-                    % (self.sourcepath, self.sourceimage)
-                )
-
-            # write files to disk (would be nice to stream them, haven't gotten it to work)
-            tempdir = tempfile.mkdtemp(dir=BUILD_TEMPDIR)
-            with open(os.path.join(tempdir, "content.tar"), "wb") as localfile:
-                for chunk in tarfile_stream:
-                    localfile.write(chunk)
-            os.mkdir(cachedir)
-            os.rename(tempdir, cachedir)
-        else:
-            print("  Using cached files from %s" % cacherelpath)
+        # copy build artifacts from the container if they haven't been prefetched
+        future = fetch(self.sourceimage, self.sourcepath)
+        if not future.done():
+            print("  Waiting for files from %s" % self.sourceimage)
+        cachedir = future.result()
+        print(
+            "  Using cached files from %s" % os.path.relpath(cachedir, BUILD_CACHEDIR)
+        )
 
-        # write Dockerfile for the new image and then build it
+        # write Dockerfile for the new image and then build it. Its name is unique to this
+        # build so that several images can copy the same cached file at the same time
         dockerfile = "FROM %s\nADD content.tar %s" % (startimage, self.destpath)
-        with open(os.path.join(cachedir, "Dockerfile"), "w") as df:
+        dockerfile_name = "Dockerfile.%s" % newimage.replace(":", "_").replace("/", "_")
+        with open(os.path.join(cachedir, dockerfile_name), "w") as df:
             df.write(dockerfile)
 
-        buildargs = dict(path=cachedir, tag=newimage, decode=True)
-        utils.set_build_cachefrom(self.cache_from, buildargs, client)
+        buildargs = dict(
+            path=cachedir,
+            dockerfile=dockerfile_name,
+            tag=newimage,
+            decode=True,
+            labels=labels,
+        )
+        utils.set_build_cachefrom(self.cache_from, buildargs, client, startimage)
 
         # Build and show logs
-        stream = client.api.build(**buildargs)
         try:
-            utils.stream_docker_logs(stream, newimage)
-        except ValueError as e:
-            raise errors.BuildError(dockerfile, e.args[0], build_args=buildargs)
-
-    def _setcache(self, client):
-        if self._sourceobj is None:  # get image and set up cache if necessary
-
-            self._sourceobj = client.images.get(self.sourceimage)
-
-            if not os.path.exists(BUILD_CACHEDIR):
-                os.mkdir(BUILD_CACHEDIR)
-
-            if not os.path.exists(BUILD_TEMPDIR):
-                os.mkdir(BUILD_TEMPDIR)
-
-            image_cachedir = os.path.join(
-                BUILD_CACHEDIR, self._sourceobj.id.replace("sha256:", "")
-            )
-            if not os.path.exists(image_cachedir):
-                os.mkdir(image_cachedir)
-
-            self._cachedir = os.path.join(
-                image_cachedir, self.sourcepath.replace("/", "_-")
-            )
-            return self._cachedir
-
-        else:  # make sure image ID hasn't changed
-            assert self._sourceobj.id == client.images.get(self.sourceimage)
-            return self._cachedir
+            stream = client.api.build(**buildargs)
+            try:
+                utils.stream_docker_logs(stream, newimage)
+            except ValueError as e:
+                raise errors.BuildError(dockerfile, e.args[0], build_args=buildargs)
+        finally:
+            os.unlink(os.path.join(cachedir, dockerfile_name))
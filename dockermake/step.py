@@ -16,15 +16,21 @@ from __future__ import print_function
 import os
 from io import StringIO, BytesIO
 import sys
+import threading
 
 from termcolor import cprint, colored
 import docker.utils, docker.errors
 
 from . import utils
+from . import hashing
 from . import staging
 from . import errors
 
 DOCKER_TMPDIR = "_docker_make_tmp/"
+# where a step's generated Dockerfile goes in the tarball that's sent as its build context
+CONTEXT_DOCKERFILE = DOCKER_TMPDIR + "Dockerfile"
+# every image docker-make builds is labeled with the input hash of its stack of steps
+INPUT_HASH_LABEL = "com.github.avirshup.dockermake.input-hash"
 
 
 class BuildStep(object):
@@ -40,6 +46,16 @@ class BuildStep(object):
         buildargs (dict): build-time "buildargs" for dockerfiles
         squash (bool): whether the result should be squashed
         secret_files (List[str]): list of files to delete prior to squashing (squash must be True)
+
+    Attributes:
+        resources (dict): resources that this step's containers are limited to -
+           ``cpus`` (float), ``memory`` and ``shm`` (in bytes) - if declared. ``cpus`` is
+           only a relative scheduling weight (docker's CPU shares), not a hard limit
+        parent (BuildStep): the step that this step is built on (None for the first step)
+        cache_name (str): name to push this step's image to as a cache source for future
+           builds (None unless steps are cached)
+        definition_key (str): identifies this step by its definition and those of the
+           steps before it - unlike ``buildname``, it's the same in every run
     """
 
     def __init__(
@@ -68,6 +84,12 @@ class BuildStep(object):
         self.buildargs = buildargs
         self.squash = squash
         self.secret_files = secret_files
+        self.resources = self._get_resources(img_def)
+        self.parent = None
+        self.cache_name = None
+        self.definition_key = None
+        self._input_hash = None
+        self._context_hash = None
 
         if secret_files:
             assert (
@@ -79,6 +101,25 @@ class BuildStep(object):
         else:
             self.cache_from = cache_from
 
+        self._users = 0
+        self._users_lock = threading.Lock()
+
+    def add_user(self):
+        """ Register another target whose build includes this step
+        """
+        with self._users_lock:
+            self._users += 1
+
+    def release(self):
+        """ Called when a target that includes this step is finished with it.
+
+        Returns:
+            bool: True if no other targets still need this step's image
+        """
+        with self._users_lock:
+            self._users -= 1
+            return self._users <= 0
+
     @staticmethod
     def _get_ignorefile(img_def):
         if img_def.get("ignore", None) is not None:
@@ -95,7 +136,17 @@ class BuildStep(object):
 
         return list(filter(bool, lines))
 
-    def build(self, client, pull=False, usecache=True):
+    @staticmethod
+    def _get_resources(img_def):
+        resources = {}
+        for key, value in img_def.get("resources", {}).items():
+            if key == "cpus":
+                resources[key] = float(value)
+            else:
+                resources[key] = docker.utils.parse_bytes(value)
+        return resources
+
+    def build(self, client, pull=False, usecache=True, cache_from=None):
         """
         Drives an individual build step. Build steps are separated by build_directory.
         If a build has zero one or less build_directories, it will be built in a single
@@ -105,6 +156,7 @@ class BuildStep(object):
             client (docker.Client): docker client object that will build the image
             pull (bool): whether to pull dependent layers from remote repositories
             usecache (bool): whether to use cached layers or rebuild from scratch
+            cache_from (List[str]): cache images to use instead of ``self.cache_from``
         """
         print(
             colored("  Building step", "blue"),
@@ -135,25 +187,24 @@ class BuildStep(object):
             rm=True,
             buildargs=self.buildargs,
             squash=self.squash,
+            labels={INPUT_HASH_LABEL: self.input_hash},
         )
 
         if usecache:
-            utils.set_build_cachefrom(self.cache_from, kwargs, client)
+            utils.set_build_cachefrom(
+                cache_from or self.cache_from, kwargs, client, self.baseimage
+            )
+
+        if self.resources:
+            self._set_resource_limits(kwargs)
 
         if self.build_dir is not None:
-            tempdir = self.write_dockerfile(dockerfile)
             context_path = os.path.abspath(os.path.expanduser(self.build_dir))
-            kwargs.update(
-                fileobj=None, dockerfile=os.path.join(DOCKER_TMPDIR, "Dockerfile")
-            )
             print(
                 colored("  Build context:", "blue"),
                 colored(os.path.relpath(context_path), "blue", attrs=["bold"]),
             )
-
-            if not self.custom_exclude:
-                kwargs.update(path=context_path)
-            else:
+            if self.custom_exclude:
                 print(
                     colored("  Custom .dockerignore from:", "blue"),
                     colored(
@@ -161,14 +212,19 @@ class BuildStep(object):
                     ),
                 )
 
-                # AMV - this is a brittle call to an apparently "private' docker sdk method
-                context = docker.utils.tar(
-                    self.build_dir,
-                    exclude=self.custom_exclude,
-                    dockerfile=(os.path.join(DOCKER_TMPDIR, "Dockerfile"), dockerfile),
-                    gzip=False,
-                )
-                kwargs.update(fileobj=context, custom_context=True)
+            # The Dockerfile is only added to the tarball sent to docker, never written
+            # into the build directory - so that steps sharing a directory don't send
+            # each other's Dockerfiles, and the context is the same in every run.
+            # AMV - this is a brittle call to an apparently "private' docker sdk method
+            context = docker.utils.tar(
+                context_path,
+                exclude=self.context_excludes,
+                dockerfile=(CONTEXT_DOCKERFILE, dockerfile),
+                gzip=False,
+            )
+            kwargs.update(
+                fileobj=context, custom_context=True, dockerfile=CONTEXT_DOCKERFILE
+            )
 
         else:
             if sys.version_info.major == 2:
@@ -178,8 +234,6 @@ class BuildStep(object):
 
             kwargs.update(fileobj=fileobj, path=None, dockerfile=None)
 
-            tempdir = None
-
         # start the build
         stream = client.api.build(**kwargs)
         try:
@@ -202,10 +256,17 @@ class BuildStep(object):
         if self.squash and not self.bust_cache:
             self._resolve_squash_cache(client)
 
-        # remove the temporary dockerfile
-        if tempdir is not None:
-            os.unlink(os.path.join(tempdir, "Dockerfile"))
-            os.rmdir(tempdir)
+    def _set_resource_limits(self, kwargs):
+        limits = {}
+        if "cpus" in self.resources:
+            limits["cpushares"] = int(self.resources["cpus"] * 1024)
+        if "memory" in self.resources:
+            limits["memory"] = self.resources["memory"]
+        if limits:
+            kwargs["container_limits"] = limits
+        if "shm" in self.resources:
+            kwargs["shmsize"] = self.resources["shm"]
+        cprint("  Resource limits: %s" % self.img_def["resources"], "blue")
 
     def _resolve_squash_cache(self, client):
         """
@@ -292,21 +353,76 @@ class BuildStep(object):
             client.api.tag(cached_squashed_sha, self.buildname, force=True)
             return
 
-    def write_dockerfile(self, dockerfile):
-        tempdir = os.path.abspath(os.path.join(self.build_dir, DOCKER_TMPDIR))
-        temp_df = os.path.join(tempdir, "Dockerfile")
-        if not os.path.isdir(tempdir):
-            os.makedirs(tempdir)
-        with open(temp_df, "w") as df_out:
-            print(dockerfile, file=df_out)
-        return tempdir
+    @property
+    def input_hash(self):
+        """ str: hash of everything that goes into this step's image - the step it's built
+        on (recursively), its Dockerfile, build context, buildargs and squashing
+        """
+        if self._input_hash is None:
+            self._input_hash = hashing.hash_json(self.get_inputs())
+        return self._input_hash
+
+    def get_inputs(self):
+        """ The inputs that ``input_hash`` is computed from
+
+        Returns:
+            dict: JSON-serializable description of the inputs
+        """
+        inputs = dict(
+            parent=self._get_parent_input(),
+            dockerfile=self.dockerfile_lines[1:],  # everything but the FROM line
+            buildargs=self.buildargs or {},
+            squash=bool(self.squash),
+        )
+        if self.build_dir is not None:
+            inputs["context"] = self.context_hash
+        return inputs
+
+    def _get_parent_input(self):
+        if self.parent is not None:
+            return self.parent.input_hash
+        elif self.build_first is not None:
+            return "FROM_DOCKERFILE %s" % self.build_first.digest
+        else:  # the exact image, so an updated base image changes the hash
+            return "FROM %s" % utils.resolve_base_image(self.baseimage)
+
+    @property
+    def context_hash(self):
+        """ str: hash of the build context that's sent to docker (None if there's none)
+        """
+        if self.build_dir is None:
+            return None
+        if self._context_hash is None:
+            self._context_hash = hashing.hash_build_context(
+                os.path.expanduser(self.build_dir),
+                dockerfile=CONTEXT_DOCKERFILE,
+                ignore=self.context_excludes,
+            )
+        return self._context_hash
+
+    @property
+    def context_excludes(self):
+        """ List[str]: .dockerignore patterns for the build context. docker-make's own
+        files (the generated Dockerfile and .dockerignore) are never part of it.
+        """
+        if self.custom_exclude:
+            patterns = list(self.custom_exclude)
+        else:
+            patterns = hashing.read_dockerignore(os.path.expanduser(self.build_dir))
+            patterns.append(DOCKER_TMPDIR.rstrip("/"))
+        return patterns + [".dockerignore"]
 
     @staticmethod
     def build_external_dockerfile(client, image):
         import docker.errors
 
-        cprint("  Building base image from %s" % image, "blue")
         assert not image.built
+        if image.exists(client):
+            cprint("  Using existing image %s for %s" % (image.tag, image), "blue")
+            image.built = True
+            return
+
+        cprint("  Building base image from %s" % image, "blue")
 
         stream = client.api.build(
             path=os.path.dirname(image.path),
@@ -366,20 +482,39 @@ class FileCopyStep(BuildStep):
     def __init__(self, sourceimage, sourcepath, destpath, *args, **kwargs):
         kwargs.pop("bust_cache", None)
         super(FileCopyStep, self).__init__(*args, **kwargs)
+        self.resources = {}  # copies don't run the definition's build instructions
         self.sourceimage = sourceimage
         self.sourcepath = sourcepath
         self.destpath = destpath
+        self.source_build = None  # the BuildTarget for sourceimage
 
-    def build(self, client, pull=False, usecache=True):
+    def get_inputs(self):
+        if self.source_build is not None:
+            source = self.source_build.steps[-1].input_hash
+        else:
+            source = self.sourceimage
+        return dict(
+            parent=self._get_parent_input(),
+            source=source,
+            sourcepath=self.sourcepath,
+            destpath=self.destpath,
+        )
+
+    def build(self, client, pull=False, usecache=True, cache_from=None):
         """
          Note:
             `pull` and `usecache` are for compatibility only. They're irrelevant because
             hey were applied when BUILDING self.sourceimage
         """
         stage = staging.StagedFile(
-            self.sourceimage, self.sourcepath, self.destpath, cache_from=self.cache_from
+            self.sourceimage,
+            self.sourcepath,
+            self.destpath,
+            cache_from=cache_from or self.cache_from,
+        )
+        stage.stage(
+            self.baseimage, self.buildname, labels={INPUT_HASH_LABEL: self.input_hash}
         )
-        stage.stage(self.baseimage, self.buildname)
 
     @property
     def dockerfile_lines(self):
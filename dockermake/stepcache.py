@@ -0,0 +1,117 @@
+# Copyright 2015-2017 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Remembers which image each build step produced, indexed by the step's inputs, so that
+a step whose inputs haven't changed is just tagged - without running a docker build.
+
+Also remembers the image most recently built for each step (by its definition key) and
+target name, whatever its inputs were, to use as a cache source for the next build.
+"""
+from __future__ import print_function
+
+import os
+
+import docker.errors
+
+from . import hashing
+from . import staging
+from . import utils
+
+RESULTS_DIR = "step_results"
+LAST_BUILDS_DIR = "last_builds"
+
+
+def results_dir():
+    """ Directory holding the index (one file per step result, in the state directory)
+    """
+    return os.path.join(staging.STATE_DIR, RESULTS_DIR)
+
+
+def result_key(client, step):
+    """ Hash of a step's own inputs and the IDs of the images it's built from
+
+    Args:
+        client (docker.DockerClient): client for the daemon that the step is built on
+        step (BuildStep): the step
+
+    Returns:
+        str: hex digest (or None, if an image that the step is built from isn't present)
+    """
+    from .step import FileCopyStep
+
+    inputs = step.get_inputs()
+    try:
+        inputs["parent"] = client.images.get(step.baseimage).id
+        if isinstance(step, FileCopyStep):
+            inputs["source"] = client.images.get(step.sourceimage).id
+    except docker.errors.ImageNotFound:
+        return None
+    return hashing.hash_json(inputs)
+
+
+def lookup(client, key):
+    """ Returns the ID of the image recorded for this key, if it still exists (or None)
+    """
+    try:
+        with open(os.path.join(results_dir(), key), "r") as resultfile:
+            imageid = resultfile.read().strip()
+    except (IOError, OSError):
+        return None
+
+    try:
+        client.images.get(imageid)
+    except docker.errors.ImageNotFound:
+        return None
+    return imageid
+
+
+def record(client, key, image):
+    """ Record that the step with this key produced this image
+    """
+    utils.write_atomically(
+        os.path.join(results_dir(), key), client.images.get(image).id
+    )
+
+
+def record_last_build(name, imageid):
+    """ Record the image that was just built for a step's definition key or a target name
+    """
+    utils.write_atomically(
+        os.path.join(_last_builds_dir(), hashing.hash_json(name)), imageid
+    )
+
+
+def previous_builds(client, names):
+    """ The images most recently built for these step definition keys or target names,
+    if they're still present (in the order of the names, without duplicates)
+
+    Returns:
+        List[str]: image IDs
+    """
+    imageids = []
+    for name in names:
+        path = os.path.join(_last_builds_dir(), hashing.hash_json(name))
+        try:
+            with open(path, "r") as lastfile:
+                imageid = lastfile.read().strip()
+            client.images.get(imageid)
+        except (IOError, OSError, docker.errors.ImageNotFound):
+            continue
+        if imageid not in imageids:
+            imageids.append(imageid)
+    return imageids
+
+
+def _last_builds_dir():
+    return os.path.join(staging.STATE_DIR, LAST_BUILDS_DIR)
@@ -0,0 +1,106 @@
+# Copyright 2015-2017 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Records how long each build step takes, so that future builds can be scheduled by cost.
+"""
+from __future__ import print_function
+
+import json
+import os
+import threading
+from builtins import object
+
+from . import staging
+from . import utils
+
+TIMINGS_FILE = "step_timings.json"
+DEFAULT_STEP_SECONDS = 10.0  # estimate for steps that have never been timed
+SMOOTHING = 0.5  # weight of the newest measurement in the running estimate
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """ Returns the timing store for this session (loading it the first time)
+    """
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            _store = TimingStore(os.path.join(staging.STATE_DIR, TIMINGS_FILE))
+        return _store
+
+
+def step_key(step):
+    """ Identifies a step by image definition, so that its timings apply across targets
+    """
+    from .step import FileCopyStep
+
+    if isinstance(step, FileCopyStep):
+        return "%s <- %s:%s" % (step.imagename, step.sourceimage, step.sourcepath)
+    else:
+        return step.imagename
+
+
+class TimingStore(object):
+    """ Persistent record of step durations, stored as JSON.
+
+    Args:
+        path (str): path of the JSON file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._updated = {}
+        self.seconds = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as jsonfile:
+                return json.load(jsonfile)["seconds"]
+        except (IOError, OSError, ValueError, KeyError):
+            return {}
+
+    def record(self, key, seconds):
+        with self._lock:
+            if key in self.seconds:
+                seconds = SMOOTHING * seconds + (1.0 - SMOOTHING) * self.seconds[key]
+            self.seconds[key] = self._updated[key] = seconds
+
+    def estimate(self, key):
+        """ Expected duration in seconds (or DEFAULT_STEP_SECONDS if it's never been built)
+        """
+        with self._lock:
+            return self.seconds.get(key, DEFAULT_STEP_SECONDS)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self.seconds
+
+    def save(self):
+        """ Write this session's measurements to disk, keeping any that other processes
+        have written in the meantime.
+        """
+        with self._lock:
+            if not self._updated:
+                return
+            seconds = self._read()
+            seconds.update(self._updated)
+
+            utils.write_atomically(
+                self.path, json.dumps({"seconds": seconds}, indent=1, sort_keys=True)
+            )
+            self._updated = {}
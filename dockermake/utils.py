@@ -15,15 +15,23 @@ from __future__ import print_function
 
 import collections
 import os
+import tempfile
 import textwrap
+import threading
+from contextlib import contextmanager
 
 import yaml
 import docker.errors
+import docker.utils
 from termcolor import cprint, colored
 
 from . import errors
 
 _dockerclient = None
+_thread_clients = threading.local()  # for threads that build on another daemon
+
+_resolved_base_images = {}  # maps base image names to what they resolved to
+_resolved_base_images_lock = threading.Lock()
 
 
 def get_client_api():
@@ -33,12 +41,69 @@ def get_client_api():
 def get_client():
     global _dockerclient
 
+    client = getattr(_thread_clients, "client", None)
+    if client is not None:
+        return client
+
     if _dockerclient is None:
         _dockerclient = docker.from_env(version="auto")
 
     return _dockerclient
 
 
+@contextmanager
+def using_client(client):
+    """ Make ``get_client`` return this client in this thread (for builds on another
+    daemon)
+    """
+    previous = getattr(_thread_clients, "client", None)
+    _thread_clients.client = client
+    try:
+        yield
+    finally:
+        _thread_clients.client = previous
+
+
+def resolve_base_image(image):
+    """ Identifies the exact image that a base image name refers to (once per session):
+    ``repository@digest``, from the local image if it's present or else from the
+    registry; the image ID, for a local image that isn't from a registry; or just the
+    name, if neither docker nor the registry can tell.
+
+    Args:
+        image (str): name of the base image
+
+    Returns:
+        str: the resolved name
+    """
+    with _resolved_base_images_lock:
+        if image not in _resolved_base_images:
+            _resolved_base_images[image] = _resolve_base_image(image)
+        return _resolved_base_images[image]
+
+
+def _resolve_base_image(image):
+    repository, _ = docker.utils.parse_repository_tag(image)
+    try:
+        client = get_client()
+        local = client.images.get(image)
+    except docker.errors.ImageNotFound:
+        pass
+    except docker.errors.DockerException:  # e.g., no daemon, with --no-build
+        return image
+    else:
+        for repodigest in local.attrs.get("RepoDigests") or []:
+            if docker.utils.parse_repository_tag(repodigest)[0] == repository:
+                return repodigest
+        return local.id
+
+    try:
+        digest = client.api.inspect_distribution(image)["Descriptor"]["digest"]
+    except (docker.errors.APIError, KeyError):
+        return image
+    return "%s@%s" % (repository, digest)
+
+
 def list_image_defs(args, defs):
     from . import imagedefs
 
@@ -70,13 +135,15 @@ def generate_name(image, repo, tag):
 
 
 def get_build_targets(args, defs):
+    from . import imagedefs
+
     if args.requires or args.name:
         # Assemble a custom target from requirements
         assert args.requires and args.name
         assert args.name not in defs.ymldefs
         defs.ymldefs[args.name] = {
             "requires": args.requires,
-            "_sourcefile": "command line arguments",
+            "_sourcefile": imagedefs.CUSTOM_TARGET_SOURCE,
         }
         targets = [args.name]
 
@@ -93,37 +160,235 @@ def get_build_targets(args, defs):
         # build the user-specified targets
         targets = args.TARGETS
 
+    if args.shard:
+        index, count = args.shard
+        if args.canonical_order:
+            defs.use_canonical_order()
+        shard = defs.shard(targets, index, count)
+        cprint("Shard %d/%d:" % (index, count), "blue", end=" ")
+        print("building %d of %d targets" % (len(shard), len(targets)))
+        targets = shard
+
     return targets
 
 
+def warm_targets(args, defs, targets):
+    """ Pull every external base and cache image that the targets need
+
+    Returns:
+        List[str]: warnings
+    """
+    from . import daemons
+    from . import warm
+
+    if args.host:
+        clients = [d.client for d in daemons.DaemonPool(args.host).daemons]
+    else:
+        clients = [get_client()]
+
+    builders = _generate_builders(args, defs, targets)
+    warnings = []
+    for client in clients:
+        warnings.extend(
+            warm.pull_images(client, warm.external_images(builders), args.pull_jobs)
+        )
+    return warnings
+
+
 def build_targets(args, defs, targets):
+    return run_builds(args, _generate_builders(args, defs, targets))
+
+
+def write_plan(args, defs, targets):
+    """ Resolve the build for these targets, and write it to the file ``args.plan``
+    """
+    from . import plan
+
+    builders = _generate_builders(args, defs, targets)
+    plan.write_plan(args.plan, builders)
+    print("Wrote build plan for %d targets to %s" % (len(builders), args.plan))
+
+
+def execute_plan(args):
+    """ Build the targets in the plan file ``args.execute`` (only ``args.TARGETS``, if
+    any are given)
+    """
+    from . import plan
+
+    builders = plan.load_plan(args.execute, args.TARGETS)
+    cprint("\nRequested images from %s: " % args.execute, "blue", end="")
+    print(", ".join(b.targetname for b in builders))
+    return run_builds(args, builders)
+
+
+def run_builds(args, builders):
+    """ Build a list of targets (or just write their Dockerfiles), as configured by the
+    command line arguments
+
+    Args:
+        args (argparse.Namespace): parsed command line arguments
+        builders (List[BuildTarget]): targets to build
+
+    Returns:
+        List[str]: description of each target that was built
+        List[str]: warnings
+        List[str]: targets that failed to build
+        List[str]: targets that were skipped, because something they need failed
+    """
+    from .scheduler import BuildScheduler
+    from . import concurrency
+    from . import daemons
+    from . import warm
+
+    daemon_pool = None
     if args.no_build:
         client = None
+        clients = []
+    elif args.host:
+        if args.jobs == "auto":
+            raise errors.CLIError("--jobs auto can't be used with --host")
+        if args.cpu_budget is not None or args.memory_budget is not None:
+            raise errors.CLIError(
+                "--cpu-budget and --memory-budget can't be used with --host"
+            )
+        daemon_pool = daemons.DaemonPool(args.host)
+        daemons.set_pool(daemon_pool)
+        clients = [daemon.client for daemon in daemon_pool.daemons]
+        client = clients[0]
     else:
         client = get_client()
+        clients = [client]
 
     if args.push_to_registry and args.registry_user:
         if not args.repository:
             raise errors.NoRegistryError("No registry specified to push images to.")
         registry = args.repository.split("/")[0]
-        client.login(
-            args.registry_user,
-            password=args.registry_token,
-            registry=registry,
-            reauth=True,
-        )
+        for c in clients:
+            c.login(
+                args.registry_user,
+                password=args.registry_token,
+                registry=registry,
+                reauth=True,
+            )
         print("\nREGISTRY LOGIN SUCCESS:", registry)
 
+    built, warnings = [], []
+
+    # get the base images up front, rather than one build at a time
+    for c in clients:
+        images = warm.external_images(builders, include_cache=False)
+        if not args.pull:
+            images = warm.missing_images(c, images)
+        warnings.extend(warm.pull_images(c, images, args.pull_jobs))
+
+    def finished(b, alias_of=None):
+        if not args.no_build:
+            print("  docker-make built:", b.targetname)
+
+        if args.print_dockerfiles or args.no_build:
+            b.write_dockerfile(args.dockerfile_dir)
+
+        built.append(b.targetname)
+        if alias_of is not None:
+            built[-1] += " -- same image as %s" % alias_of
+        if pushes is not None:
+            pushes.submit(b.targetname, aliases=[b.prebuilt_name])
+            pushed.append(len(built) - 1)
+
+    def steps_built(steps):
+        if cache_pushes is None:
+            return
+        for step in steps:
+            if step.cache_name is not None and step.cache_name not in cache_pushed:
+                cache_pushes.submit(step.cache_name)
+                cache_pushed.add(step.cache_name)
+
+    if args.push_to_registry and not args.no_build:
+        pushes = concurrency.PushQueue(client, args.push_jobs)
+    else:
+        pushes = None
+    pushed = []  # index in `built` of each queued push
+
+    if args.cache_steps and not args.no_build:
+        if not args.cache_repo:
+            raise errors.CLIError("--cache-steps requires a --cache-repo to push to")
+        cache_pushes = concurrency.PushQueue(client, args.push_jobs)
+    else:
+        cache_pushes = None
+    cache_pushed = set()
+
+    jobs = args.jobs
+    if jobs == "auto" and args.no_build:
+        jobs = 1
+    elif jobs == "auto":
+        limiter = concurrency.AdaptiveLimiter(client, args.min_jobs, args.max_jobs)
+        concurrency.set_limiter(limiter)
+        jobs = limiter.max_jobs
+        cprint(
+            "Adapting concurrent builds to daemon load (%d to %d, starting at %d)"
+            % (limiter.min_jobs, limiter.max_jobs, limiter.limit),
+            "blue",
+        )
+
+    if jobs != 1 and not args.no_build and daemon_pool is None:
+        concurrency.set_resource_pool(_make_resource_pool(args, client))
+    elif not args.no_build and (
+        args.cpu_budget is not None or args.memory_budget is not None
+    ):
+        warn = (
+            "WARNING: --cpu-budget and --memory-budget are ignored - "
+            "steps are built one at a time"
+        )
+        print(warn)
+        warnings.append(warn)
+
+    scheduler = BuildScheduler(
+        builders,
+        client,
+        jobs=jobs,
+        nobuild=args.no_build,
+        usecache=not args.no_cache,
+        pull=args.pull,
+        pull_if_built=args.pull_if_built,
+        keep_going=args.keep_going,
+        daemon_pool=daemon_pool,
+    )
+    try:
+        scheduler.run(on_finished=finished, on_built=steps_built)
+    finally:
+        if pushes is not None:
+            for ibuilt, (name, success, w) in zip(pushed, pushes.drain()):
+                warnings.extend(w)
+                if not success:
+                    built[ibuilt] += " -- PUSH FAILED"
+                else:
+                    built[ibuilt] += " -- pushed to %s" % name.split("/")[0]
+        if cache_pushes is not None:
+            for name, success, w in cache_pushes.drain():
+                warnings.extend(w)
+
+    failed = [
+        "%s (%s)" % (node.key[1], type(exc).__name__)
+        for node, exc in scheduler.failed.items()
+    ]
+    skipped = [node.key[1] for node in scheduler.skipped]
+    return built, warnings, failed, skipped
+
+
+def _generate_builders(args, defs, targets):
     if args.build_arg:
         buildargs = _make_buildargs(args.build_arg)
     else:
         buildargs = None
-    built, warnings = [], []
 
     builders = []
     cprint("\nRequested images: ", "blue", end="")
     print(", ".join("%s" % t for t in targets))
 
+    if args.canonical_order:
+        defs.use_canonical_order()
+        _report_prefix_sharing(defs, targets)
+
     for t in targets:
         try:
             builder = defs.generate_build(
@@ -132,6 +397,7 @@ def build_targets(args, defs, targets):
                 rebuilds=args.bust_cache,
                 cache_repo=args.cache_repo,
                 cache_tag=args.cache_tag,
+                cache_steps=args.cache_steps,
                 keepbuildtags=args.keep_build_tags,
                 buildargs=buildargs,
             )
@@ -147,26 +413,69 @@ def build_targets(args, defs, targets):
         else:
             builders.append(builder)
 
-    for b in builders:
-        b.build(
-            client, nobuild=args.no_build, usecache=not args.no_cache, pull=args.pull
-        )
-        if not args.no_build:
-            print("  docker-make built:", b.targetname)
+    return builders
 
-        if args.print_dockerfiles or args.no_build:
-            b.write_dockerfile(args.dockerfile_dir)
 
-        built.append(b.targetname)
-        if args.push_to_registry and not args.no_build:
-            success, w = push(client, b.targetname)
-            warnings.extend(w)
-            if not success:
-                built[-1] += " -- PUSH FAILED"
-            else:
-                built[-1] += " -- pushed to %s" % b.targetname.split("/")[0]
+def write_atomically(path, content):
+    """ Replace a file's content atomically, so that concurrent readers (in this or other
+    processes) never see a partial write
 
-    return built, warnings
+    Args:
+        path (str): the file to write (its directory is created if necessary)
+        content (str): its new content
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temppath = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as outfile:
+        outfile.write(content)
+    os.replace(temppath, path)
+
+
+def configure_copy_cache(args):
+    """ Apply the --copy-cache-dir and --copy-cache-size arguments
+    """
+    from . import staging
+
+    maxsize = None
+    if args.copy_cache_size is not None:
+        try:
+            maxsize = docker.utils.parse_bytes(args.copy_cache_size)
+        except docker.errors.DockerException:
+            raise errors.CLIError(
+                "Invalid --copy-cache-size %s (expected e.g. 20g)"
+                % args.copy_cache_size
+            )
+    staging.configure_copy_cache(args.copy_cache_dir, maxsize)
+
+
+def _make_resource_pool(args, client):
+    from .concurrency import ResourcePool
+
+    if args.cpu_budget is None or args.memory_budget is None:
+        info = client.info()
+    cpus = args.cpu_budget if args.cpu_budget is not None else info["NCPU"]
+    if args.memory_budget is not None:
+        try:
+            memory = docker.utils.parse_bytes(args.memory_budget)
+        except docker.errors.DockerException:
+            raise errors.CLIError(
+                "Invalid --memory-budget %s (expected e.g. 32g)" % args.memory_budget
+            )
+    else:
+        memory = info["MemTotal"]
+    return ResourcePool(cpus, memory)
+
+
+def _report_prefix_sharing(defs, targets):
+    unique, total = defs.count_unique_steps(targets, canonical=True)
+    default, _ = defs.count_unique_steps(targets, canonical=False)
+    cprint("Canonical step order:", "blue", end=" ")
+    print(
+        "%d unique steps to build for %d total steps (%d shared); "
+        "`requires` order: %d unique steps (%d shared)"
+        % (unique, total, total - unique, default, total - default)
+    )
 
 
 def _make_buildargs(build_args):
@@ -227,6 +536,17 @@ def human_readable_size(num, suffix="B"):
     return "%.1f%s%s" % (num, "Yi", suffix)
 
 
+def human_readable_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%dh%02dm%02ds" % (hours, minutes, seconds)
+    elif minutes:
+        return "%dm%02ds" % (minutes, seconds)
+    else:
+        return "%ds" % seconds
+
+
 def stream_docker_logs(stream, name):
     textwidth = get_console_width() - 5
     if textwidth <= 10:
@@ -298,19 +618,20 @@ def _show_xfer_state(pullstats, item):
         return None
 
 
-def set_build_cachefrom(cache_from, buildargs, client):
-    if cache_from:  # use cachefrom only if at least one of the images exists
-        for image in cache_from:
-            try:
-                client.images.get(image)
-            except docker.errors.ImageNotFound:
-                pass
-            else:
-                cprint("  Build cache sources: %s" % cache_from, "blue")
-                buildargs["cache_from"] = cache_from
-                return
+def set_build_cachefrom(cache_from, buildargs, client, parent):
+    """ Pass docker the cache images that can help build on ``parent`` (see
+    ``cachesources.resolve``)
+    """
+    from . import cachesources
+
+    if cache_from:
+        useful = cachesources.resolve(client, cache_from, parent)
+        if useful:
+            cprint("  Build cache sources: %s" % useful, "blue")
+            buildargs["cache_from"] = useful
         else:
             cprint(
-                "  No build cache sources present; ignoring --cache-repo and --cache-tag",
+                "  None of the build cache sources can help with this step: %s"
+                % cache_from,
                 "blue",
             )
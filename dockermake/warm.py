@@ -0,0 +1,167 @@
+# Copyright 2015-2017 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Pulls the external images that a build needs (base images and cache images) before it
+starts, all at the same time.
+"""
+from __future__ import print_function
+
+import threading
+import time
+from builtins import object
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import docker.errors
+import docker.utils
+from termcolor import cprint
+
+from . import utils
+
+PROGRESS_INTERVAL = 2.0  # minimum number of seconds between progress reports
+
+
+def external_images(builders, include_cache=True):
+    """ Find the images from outside this build that the targets are built from or use
+    as cache sources, including those of the images that they copy files from.
+
+    Args:
+        builders (List[BuildTarget]): targets to be built
+        include_cache (bool): include the cache images (otherwise, they're pulled by
+           each step, and only if they'll help - see ``cachesources.resolve``)
+
+    Returns:
+        OrderedDict[str, str]: maps each image name to its use (``"base"`` or ``"cache"``)
+    """
+    images = OrderedDict()
+    seen = set()
+    tovisit = list(builders)
+    while tovisit:
+        builder = tovisit.pop(0)
+        if builder.targetname in seen:
+            continue
+        seen.add(builder.targetname)
+        tovisit.extend(builder.sourcebuilds)
+
+        if isinstance(builder.from_image, str):  # i.e., not an ExternalDockerfile
+            images.setdefault(builder.from_image, "base")
+        for step in builder.steps if include_cache else []:
+            for image in step.cache_from or []:
+                images.setdefault(image, "cache")
+    return images
+
+
+def missing_images(client, images):
+    """ Remove the images that are already present locally
+    """
+    missing = OrderedDict()
+    for image, use in images.items():
+        try:
+            client.images.get(image)
+        except docker.errors.ImageNotFound:
+            missing[image] = use
+    return missing
+
+
+def pull_images(client, images, jobs=4):
+    """ Pull images concurrently, printing the overall progress of all the pulls.
+
+    Images that can't be pulled only generate warnings - the build itself will report
+    a missing base image, and missing cache images are just ignored.
+
+    Args:
+        client (docker.DockerClient): client to pull with
+        images (Mapping[str, str]): images to pull (see ``external_images``)
+        jobs (int): maximum number of images to pull at the same time
+
+    Returns:
+        List[str]: warnings
+    """
+    if not images:
+        return []
+
+    cprint("Pulling %d base and cache images" % len(images), "blue")
+    progress = _PullProgress(len(images))
+    warnings = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        pulls = {pool.submit(_pull, client, image, progress): image for image in images}
+        for future in as_completed(pulls):
+            image = pulls[future]
+            try:
+                future.result()
+            except (docker.errors.APIError, ValueError) as exc:
+                warn = "WARNING: could not pull %s image %s: %s" % (
+                    images[image],
+                    image,
+                    exc,
+                )
+                print(warn)
+                warnings.append(warn)
+                progress.finish(image, success=False)
+            else:
+                progress.finish(image, success=True)
+    return warnings
+
+
+def _pull(client, image, progress):
+    repository, tag = docker.utils.parse_repository_tag(image)
+    for item in client.api.pull(repository, tag or "latest", stream=True, decode=True):
+        if "error" in item or "errorDetail" in item:
+            raise ValueError(item.get("error", item))
+        progress.update(image, item)
+
+
+class _PullProgress(object):
+    """ Adds up the layer downloads of all running pulls into a single progress line
+    """
+
+    def __init__(self, numimages):
+        self.numimages = numimages
+        self.numdone = 0
+        self.layers = {}  # maps (image, layer id) to (bytes downloaded, total bytes)
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, image, item):
+        detail = item.get("progressDetail") or {}
+        if "id" not in item or not detail.get("total"):
+            return
+        with self._lock:
+            self.layers[image, item["id"]] = (detail.get("current", 0), detail["total"])
+            if time.time() - self._last_report >= PROGRESS_INTERVAL:
+                print("  Pulling:", end=" ")
+                self._report()
+
+    def finish(self, image, success):
+        with self._lock:
+            self.numdone += 1
+            for key, (current, total) in list(self.layers.items()):
+                if key[0] == image:
+                    self.layers[key] = (total, total)
+            print("  %s %s" % ("Pulled" if success else "FAILED", image), end="; ")
+            self._report()
+
+    def _report(self):
+        self._last_report = time.time()
+        current = sum(c for c, _ in self.layers.values())
+        total = sum(t for _, t in self.layers.values())
+        print(
+            "%d/%d images done, %s/%s downloaded"
+            % (
+                self.numdone,
+                self.numimages,
+                utils.human_readable_size(current),
+                utils.human_readable_size(total),
+            )
+        )
@@ -16,6 +16,7 @@ ERROR_CODES = {
     "data/invalid_yaml.yml": errors.ParsingFailure,
     "data/multi_ignore.yml": errors.MultipleIgnoreError,
     "data/buildfailure.yml": errors.BuildError,
+    "data/bad_resources.yml": errors.ParsingFailure,
 }
 
 
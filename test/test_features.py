@@ -1,3 +1,4 @@
+import json
 import os
 
 import docker.errors
@@ -269,3 +270,546 @@ def test_implicit_all_with_abstract_steps(abstract_steps):
     client.images.get("definite")
     with pytest.raises(docker.errors.ImageNotFound):
         client.images.get("abstract")
+
+
+def test_parallel_all(alltest):
+    run_docker_make("-f data/implicit_all.yml --all --jobs 4")
+    for s in "t1 t2 t3 t4".split():
+        helpers.assert_file_content(s, "/opt/%s" % s, s)
+
+
+shared_source = helpers.creates_images("shared-artifact", "copier1", "copier2")
+
+
+def test_shared_source_built_once(shared_source):
+    run_docker_make("-f data/shared_source.yml copier1 copier2 --jobs 2")
+    artifact = helpers.get_file_content("shared-artifact", "/opt/artifact")
+    helpers.assert_file_content("copier1", "/opt/artifact", artifact)
+    helpers.assert_file_content("copier2", "/opt/artifact", artifact)
+
+
+shared_prefix = helpers.creates_images(
+    "prefix1", "prefix2", "1.prefix1.dmk", "2.prefix1.dmk", "2.prefix2.dmk"
+)
+
+
+def test_shared_prefix_built_once(shared_prefix, docker_client):
+    run_docker_make("-f data/shared_prefix.yml prefix1 prefix2 --keep-build-tags")
+    helpers.assert_file_content("prefix1", "/opt/prefix", "prefix1")
+    helpers.assert_file_content("prefix2", "/opt/prefix", "prefix2")
+    assert docker_client.images.list("1.prefix1.dmk")
+    assert not docker_client.images.list("1.prefix2.dmk")
+    assert docker_client.images.list("2.prefix2.dmk")
+
+
+def test_canonical_order(tmpdir):
+    tmpdir = str(tmpdir)
+    run_docker_make(
+        "-f data/canonical.yml -n --canonical-order --dockerfile-dir %s "
+        "canonical1 canonical2 canonical3" % tmpdir
+    )
+    dockerfiles = []
+    for target in ("canonical1", "canonical2"):
+        with open(os.path.join(tmpdir, "Dockerfile.%s" % target)) as dfile:
+            dockerfiles.append(dfile.read())
+    assert dockerfiles[0] == dockerfiles[1]
+    assert dockerfiles[0].index("echo node") < dockerfiles[0].index("echo python")
+
+
+def test_count_unique_steps():
+    from dockermake.imagedefs import ImageDefs
+
+    defs = ImageDefs("data/canonical.yml")
+    targets = ["canonical1", "canonical2", "canonical3"]
+    # the targets' own definitions only have "requires", so they aren't built as steps
+    assert defs.count_unique_steps(targets, canonical=True) == (3, 8)
+    assert defs.count_unique_steps(targets, canonical=False) == (5, 8)
+
+
+aliases = helpers.creates_images("alias-app", "alias-app-ci", "alias-custom")
+
+
+def test_identical_stacks_are_tagged(aliases, docker_client):
+    run_docker_make("-f data/aliases.yml alias-app alias-app-ci")
+    app = docker_client.images.get("alias-app")
+    assert docker_client.images.get("alias-app-ci").id == app.id
+
+    run_docker_make("-f data/aliases.yml --requires alias-app --name alias-custom")
+    assert docker_client.images.get("alias-custom").id == app.id
+
+
+keep_going = helpers.creates_images("independent")
+
+
+def test_keep_going(keep_going):
+    with pytest.raises(dockermake.errors.IncompleteBuildError):
+        run_docker_make(
+            "-f data/keep_going.yml broken needs-broken independent --keep-going"
+        )
+    helpers.assert_file_content("independent", "/opt/independent", "independent")
+
+
+def test_warm(docker_client):
+    run_docker_make("-f data/shared_source.yml --warm copier1 copier2")
+    docker_client.images.get("alpine")
+
+
+from_dockerfile = helpers.creates_images("from-dockerfile")
+
+
+def test_from_dockerfile_not_rebuilt(from_dockerfile, docker_client):
+    run_docker_make("-f data/from_dockerfile.yml from-dockerfile")
+    first = docker_client.images.get("from-dockerfile").id
+    run_docker_make("-f data/from_dockerfile.yml from-dockerfile")
+    assert docker_client.images.get("from-dockerfile").id == first
+
+
+def test_build_on_daemon_pool(alltest):
+    # a "pool" with the same daemon twice: images are already present wherever needed
+    host = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")
+    run_docker_make(
+        "-f data/implicit_all.yml --all -j 2 --host %s --host %s" % (host, host)
+    )
+    for s in "t1 t2 t3 t4".split():
+        helpers.assert_file_content(s, "/opt/%s" % s, s)
+
+
+class FakeDaemonClient(object):
+    """ Just enough of a docker client for a DaemonPool: its images, and image
+    save/load streams (``load_error`` is reported by the next load)
+    """
+
+    def __init__(self, url, images=(), load_error=None):
+        self.url, self.images_present = url, dict.fromkeys(images, b"layers")
+        self.load_error, self.loads = load_error, 0
+        self.api, self.images = self, self
+
+    def get(self, image):
+        if image not in self.images_present:
+            raise docker.errors.ImageNotFound(image)
+
+    def get_image(self, image):
+        return iter([image.encode(), b":", self.images_present[image]])
+
+    def load_image(self, data):
+        self.loads += 1
+        image, _, layers = b"".join(data).partition(b":")
+        if self.load_error is not None:
+            return [{"error": self.load_error}]
+        self.images_present[image.decode()] = layers
+        return [{"stream": "Loaded image: %s" % image.decode()}]
+
+
+def test_daemon_pool_copies_missing_images(monkeypatch):
+    from dockermake import daemons, errors
+
+    fakes = {
+        "tcp://a": FakeDaemonClient("tcp://a", images=["built"]),
+        "tcp://b": FakeDaemonClient("tcp://b"),
+        "tcp://c": FakeDaemonClient("tcp://c", load_error="no space left on device"),
+    }
+    monkeypatch.setattr(docker, "DockerClient", lambda base_url, **kw: fakes[base_url])
+    pool = daemons.DaemonPool(["tcp://a", "tcp://b", "tcp://c"])
+
+    pool.ensure(fakes["tcp://b"], "built")
+    assert fakes["tcp://b"].images_present == {"built": b"layers"}
+    pool.ensure(fakes["tcp://b"], "built")  # already there
+    pool.ensure(fakes["tcp://b"], "in-registry")  # no daemon has it
+    assert fakes["tcp://b"].loads == 1
+
+    with pytest.raises(errors.ImageTransferError) as excinfo:
+        pool.ensure(fakes["tcp://c"], "built")
+    assert "no space left on device" in str(excinfo.value)
+    assert "built" not in fakes["tcp://c"].images_present
+
+
+def test_shards_cover_all_targets_once(tmpdir):
+    tmpdir = str(tmpdir)
+    shards = []
+    for i in (1, 2, 1):
+        outdir = os.path.join(tmpdir, str(len(shards)))
+        run_docker_make(
+            "-f data/shared_prefix.yml --all -n --shard %d/2 --dockerfile-dir %s"
+            % (i, outdir)
+        )
+        shards.append(set(os.listdir(outdir)))
+
+    assert shards[0] == shards[2]  # same assignment every time
+    assert not shards[0] & shards[1]
+    assert shards[0] | shards[1] == set(
+        "Dockerfile.%s" % t for t in ("prefix-base", "prefix1", "prefix2")
+    )
+
+
+def test_plan_then_execute(tmpdir):
+    tmpdir = str(tmpdir)
+    planfile = os.path.join(tmpdir, "plan.json")
+    run_docker_make("-f data/shared_source.yml copier1 copier2 --plan %s" % planfile)
+
+    with open(planfile) as pfile:
+        plan = json.load(pfile)
+    assert plan["edges"] == [
+        ["shared-artifact", "copier1"],
+        ["shared-artifact", "copier2"],
+    ]
+    for step in plan["steps"].values():
+        assert step["input_hash"]
+
+    # the plan is all that's needed - the makefile isn't read
+    run_docker_make(
+        "-f nonexistent.yml --execute %s -n --dockerfile-dir %s copier2"
+        % (planfile, tmpdir)
+    )
+    assert os.path.isfile(os.path.join(tmpdir, "Dockerfile.copier2"))
+    assert not os.path.isfile(os.path.join(tmpdir, "Dockerfile.copier1"))
+
+
+def test_executed_plan_counts_only_selected_targets(tmpdir):
+    from dockermake import plan
+
+    planfile = str(tmpdir.join("plan.json"))
+    run_docker_make("-f data/shared_prefix.yml prefix1 prefix2 --plan %s" % planfile)
+    (target,) = plan.load_plan(planfile, ["prefix1"])
+    # so the shared step is untagged as soon as prefix1 is done with it
+    assert [step._users for step in target.steps] == [1, 1]
+
+
+def test_executed_plan_checks_dockerfiles(tmpdir):
+    import shutil
+
+    shutil.copytree("data", str(tmpdir.join("data")))
+    makefile = str(tmpdir.join("data", "from_dockerfile.yml"))
+    planfile = str(tmpdir.join("plan.json"))
+    run_docker_make("-f %s from-dockerfile --plan %s" % (makefile, planfile))
+
+    with open(str(tmpdir.join("data", "test_build", "Dockerfile")), "a") as dfile:
+        dfile.write("\nRUN echo changed\n")
+    with pytest.raises(dockermake.errors.PlanMismatchError):
+        run_docker_make("--execute %s -n" % planfile)
+
+
+def test_step_keys_and_hashes_are_stable(tmpdir):
+    plans = []
+    for i in range(2):
+        planfile = os.path.join(str(tmpdir), "plan%d.json" % i)
+        run_docker_make(
+            "-f data/shared_source.yml copier1 copier2 --plan %s" % planfile
+        )
+        with open(planfile) as pfile:
+            plans.append(json.load(pfile))
+
+    # intermediate image names are unique to each run; everything else is the same
+    names = [list(plan["steps"]) for plan in plans]
+    assert not set(names[0]) & set(names[1])
+    keys = [
+        [(s["definition_key"], s["input_hash"]) for s in plan["steps"].values()]
+        for plan in plans
+    ]
+    assert keys[0] == keys[1]
+
+
+def test_input_hashes_dont_depend_on_other_targets(tmpdir):
+    hashes = []
+    for targets in ("context1", "context2 context1"):
+        planfile = os.path.join(str(tmpdir), "plan.json")
+        run_docker_make("-f data/shared_context.yml %s --plan %s" % (targets, planfile))
+        with open(planfile) as pfile:
+            plan = json.load(pfile)
+        hashes.append(
+            [
+                plan["steps"][name]["input_hash"]
+                for name in plan["targets"]["context1"]["steps"]
+            ]
+        )
+    assert hashes[0] == hashes[1]
+
+
+@pytest.fixture
+def local_registry(docker_client):
+    container = docker_client.containers.run(
+        "registry:2", detach=True, ports={"5000/tcp": ("127.0.0.1", 5000)}
+    )
+    yield "127.0.0.1:5000"
+    container.remove(force=True)
+
+
+prebuilt = helpers.creates_images("127.0.0.1:5000/dmk-test/simple-target")
+
+
+def test_pull_if_built(local_registry, prebuilt, docker_client):
+    from dockermake.step import INPUT_HASH_LABEL
+
+    name = "%s/dmk-test/simple-target" % local_registry
+    args = "-f data/simple.yml simple-target --repository %s/dmk-test" % local_registry
+    run_docker_make(args + " --push-to-registry")
+    built = docker_client.images.get(name)
+    assert built.labels[INPUT_HASH_LABEL]
+
+    # a fresh machine would have to build it again, but it's in the registry
+    docker_client.images.remove(built.id, force=True)
+    run_docker_make(args + " --pull-if-built")
+    assert docker_client.images.get(name).id == built.id
+
+
+stepcaches = helpers.creates_images(
+    "target-twostep", "127.0.0.1:5000/cache/target-twostep"
+)
+
+
+def test_cache_steps(local_registry, stepcaches, docker_client):
+    run_docker_make(
+        "-f data/twostep.yml target-twostep --cache-repo %s/cache --cache-steps"
+        % local_registry
+    )
+    final = docker_client.images.get("target-twostep")
+    for istep in (1, 2):
+        name = "%s/cache/target-twostep:step%d" % (local_registry, istep)
+        docker_client.api.inspect_distribution(name)  # it was pushed
+    step2 = docker_client.images.get("%s/cache/target-twostep:step2" % local_registry)
+    assert step2.id == final.id
+
+
+def test_context_hash_follows_ignore_rules(tmpdir):
+    tmpdir = str(tmpdir)
+    os.mkdir(os.path.join(tmpdir, "ctx"))
+    with open(os.path.join(tmpdir, "dmk.yml"), "w") as ymlfile:
+        ymlfile.write(
+            "withcontext:\n  FROM: alpine\n  build_directory: ctx\n"
+            "  ignore: ignored.txt\n  build: ADD used.txt /opt\n"
+        )
+
+    def context_hash():
+        planfile = os.path.join(tmpdir, "plan.json")
+        run_docker_make("-f %s/dmk.yml withcontext --plan %s" % (tmpdir, planfile))
+        with open(planfile) as pfile:
+            (step,) = json.load(pfile)["steps"].values()
+        return step["inputs"]["context"]
+
+    for name in ("used.txt", "ignored.txt"):
+        with open(os.path.join(tmpdir, "ctx", name), "w") as f:
+            f.write("original")
+    original = context_hash()
+
+    with open(os.path.join(tmpdir, "ctx", "ignored.txt"), "w") as f:
+        f.write("changed")
+    assert context_hash() == original
+
+    with open(os.path.join(tmpdir, "ctx", "used.txt"), "w") as f:
+        f.write("changed")
+    assert context_hash() != original
+
+
+def test_copy_cache_size_limit(shared_source, tmpdir):
+    cachedir = str(tmpdir.join("copycache"))
+    run_docker_make(
+        "-f data/shared_source.yml copier1 --copy-cache-dir %s --copy-cache-size 1m"
+        % cachedir
+    )
+    assert helpers.file_exists("copier1", "/opt/artifact")
+
+    with open(os.path.join(cachedir, "cache_index.json")) as indexfile:
+        (entry,) = json.load(indexfile)["files"].values()
+    assert 0 < entry["size"] < 1 << 20
+
+    with pytest.raises(dockermake.errors.CLIError):
+        run_docker_make("-f data/shared_source.yml copier1 --copy-cache-size lots")
+
+
+def test_resource_budgets_rejected_with_host():
+    with pytest.raises(dockermake.errors.CLIError):
+        run_docker_make(
+            "-f data/shared_source.yml copier1 -j 2 --cpu-budget 4 "
+            "--host tcp://127.0.0.1:1 --host tcp://127.0.0.1:2"
+        )
+
+
+def test_copied_content_digest_ignores_timestamps(tmpdir):
+    import io
+    import tarfile
+    from dockermake import staging
+
+    def make_tar(name, content, mtime, uid):
+        path = str(tmpdir.join(name))
+        with tarfile.open(path, "w") as archive:
+            info = tarfile.TarInfo("artifact")
+            info.size, info.mtime, info.uid = len(content), mtime, uid
+            archive.addfile(info, io.BytesIO(content))
+        return path
+
+    original = staging.content_digest(make_tar("a.tar", b"built", 1000, 0))
+    assert staging.content_digest(make_tar("b.tar", b"built", 2000, 0)) == original
+    assert staging.content_digest(make_tar("c.tar", b"rebuilt", 1000, 0)) != original
+    # docker keeps the owners in the tarball when it ADDs it, so they must match too
+    assert staging.content_digest(make_tar("d.tar", b"built", 1000, 1)) != original
+
+
+class FakeHistoryClient(object):
+    """ Just enough of a docker client for cachesources: image histories, and pulls
+    from a fake registry
+    """
+
+    def __init__(self, local, registry):
+        self.local, self.registry, self.pulled = local, registry, []
+        self.api, self.images = self, self
+
+    def history(self, image):
+        if image not in self.local:
+            raise docker.errors.NotFound(image)
+        return [dict(CreatedBy=entry, Size=0) for entry in reversed(self.local[image])]
+
+    def pull(self, repository, tag=None):
+        image = "%s:%s" % (repository, tag)
+        if image not in self.registry:
+            raise docker.errors.NotFound(image)
+        self.pulled.append(image)
+        self.local[image] = self.registry[image]
+
+
+def test_cache_sources_must_extend_parent():
+    from dockermake import cachesources
+
+    local = {
+        "parent": ["FROM", "RUN a"],
+        "unrelated:latest": ["FROM", "RUN b", "RUN c"],
+        "parent-copy:latest": ["FROM", "RUN a"],
+        "good:latest": ["FROM", "RUN a", "RUN c"],
+    }
+    registry = {"remote:latest": ["FROM", "RUN a", "RUN d"]}
+
+    client = FakeHistoryClient(dict(local), registry)
+    candidates = ["unrelated:latest", "remote:latest", "parent-copy:latest"]
+    assert cachesources.resolve(client, candidates + ["good:latest"], "parent") == [
+        "good:latest"
+    ]
+    assert not client.pulled  # there was already a useful local candidate
+
+    assert cachesources.resolve(client, candidates, "parent", pull=False) == []
+    assert cachesources.resolve(client, candidates, "parent") == ["remote:latest"]
+    assert client.pulled == ["remote:latest"]
+
+
+def test_requested_source_image_has_one_build():
+    from dockermake.imagedefs import ImageDefs
+
+    defs = ImageDefs("data/shared_source.yml")
+    copier = defs.generate_build("copier1", "copier1")
+    source = defs.generate_build("shared-artifact", "shared-artifact")
+    assert copier.sourcebuilds == [source]
+    assert all(step._users == 1 for step in defs.steptrie.steps())
+
+
+class FakeImageClient(object):
+    """ Just enough of a docker client to resolve base images
+    """
+
+    def __init__(self, local, registry):
+        self.local, self.registry = local, registry
+        self.api, self.images = self, self
+
+    def get(self, name):
+        if name not in self.local:
+            raise docker.errors.ImageNotFound(name)
+        return self.local[name]
+
+    def inspect_distribution(self, name):
+        if name not in self.registry:
+            raise docker.errors.NotFound(name)
+        return {"Descriptor": {"digest": self.registry[name]}}
+
+
+def test_base_images_are_resolved():
+    from collections import namedtuple
+    from dockermake import utils
+
+    Image = namedtuple("Image", "id attrs")
+    client = FakeImageClient(
+        local={
+            "pulled-base:1": Image(
+                "sha256:aa", {"RepoDigests": ["pulled-base@sha256:a"]}
+            ),
+            "local-base:1": Image("sha256:bb", {"RepoDigests": []}),
+        },
+        registry={"remote-base:1": "sha256:c"},
+    )
+    with utils.using_client(client):
+        assert utils.resolve_base_image("pulled-base:1") == "pulled-base@sha256:a"
+        assert utils.resolve_base_image("local-base:1") == "sha256:bb"
+        assert utils.resolve_base_image("remote-base:1") == "remote-base@sha256:c"
+        assert utils.resolve_base_image("unknown-base:1") == "unknown-base:1"
+
+
+def test_pull_if_built_skips_unneeded_sources():
+    from dockermake.imagedefs import ImageDefs
+    from dockermake.scheduler import BuildScheduler
+
+    def run(targets):
+        defs = ImageDefs("data/shared_source.yml")
+        builders = [
+            defs.generate_build(t, "127.0.0.1:5000/dmk-test/" + t) for t in targets
+        ]
+        for builder in builders:  # only copier1 was already built
+            builder.pull_prebuilt = lambda client, built_stacks, b=builder: (
+                b.imagename == "copier1"
+            )
+        scheduler = BuildScheduler(builders, object(), pull_if_built=True)
+        scheduler._prefetch = lambda node: None  # nothing's really built
+        ran = []
+        for node in scheduler.nodes.values():
+            node.action = lambda client, node=node: ran.append(node.key[1])
+        scheduler.run()
+        return ran
+
+    assert run(["copier1"]) == []
+    assert sorted(run(["copier1", "copier2"])) == [
+        "127.0.0.1:5000/dmk-test/copier2",
+        "shared-artifact",
+    ]
+
+
+def test_steps_of_source_images_are_reported():
+    from dockermake.imagedefs import ImageDefs
+    from dockermake.scheduler import BuildScheduler
+
+    defs = ImageDefs("data/shared_source.yml")
+    builder = defs.generate_build("copier1", "127.0.0.1:5000/dmk-test/copier1")
+    scheduler = BuildScheduler([builder], object())
+    scheduler._prefetch = lambda node: None  # nothing's really built
+    for node in scheduler.nodes.values():
+        node.action = lambda client: None
+    built, finished = [], []
+    scheduler.run(on_finished=finished.append, on_built=built.extend)
+
+    assert finished == [builder]
+    (source,) = builder.sourcebuilds
+    assert set(built) == set(builder.steps) | set(source.steps)
+
+
+def test_context_hash_is_computed_once(monkeypatch):
+    from dockermake import hashing
+    from dockermake.imagedefs import ImageDefs
+
+    defs = ImageDefs("data/shared_context.yml")
+    builder = defs.generate_build("context1", "dmk-test/context1")
+    step = next(s for s in builder.steps if s.build_dir is not None)
+    calls = []
+    hash_build_context = hashing.hash_build_context
+    monkeypatch.setattr(
+        hashing,
+        "hash_build_context",
+        lambda *args, **kwargs: calls.append(args)
+        or hash_build_context(*args, **kwargs),
+    )
+    assert step.get_inputs() == step.get_inputs()
+    assert len(calls) == 1
+
+
+def test_state_dir_option(tmpdir, monkeypatch):
+    from dockermake import hashing, staging
+
+    monkeypatch.setattr(staging, "STATE_DIR", staging.STATE_DIR)  # restored after
+    statedir = str(tmpdir.join("state"))
+    run_docker_make(
+        "-f data/shared_context.yml context1 --plan %s --state-dir %s"
+        % (tmpdir.join("plan.json"), statedir)
+    )
+    assert os.listdir(os.path.join(statedir, hashing.INDEX_DIR))